@@ -0,0 +1,294 @@
+# Times carpark ingestion, snapshot generation and the hot driver endpoints against
+# synthetic data.gov.sg feeds with 1x, 10x and 100x the ~2,200 carparks in Singapore.
+# The feeds are served by a local stub HTTP server, so no network access is needed,
+# and every scale gets a fresh SQLite database in a temporary folder.
+#
+# For each case the wall time, the peak memory allocated by Python (tracemalloc) and
+# the number of SQL statements sent are recorded. Results are written as JSON, tagged
+# with the current commit, so two runs can be compared:
+#
+# Run from the repository root:
+#   python benchmarks/run_benchmarks.py --scales 1,10 --output before.json
+#   python benchmarks/run_benchmarks.py --scales 1,10 --output after.json --compare before.json
+#
+# tracemalloc slows Python down, pass --no-memory for timings closer to production.
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from website import create_app, db
+from website.models import User, Driver, Company, Reward
+
+CARPARKS = 2200
+PASSWORD = "Password1!"
+REPEAT = 20
+
+# Synthetic feeds shaped like the data.gov.sg responses
+def carpark_info_feed(count):
+    rng = random.Random(count)
+    records = []
+    for i in range(count):
+        records.append({
+            "_id": i + 1,
+            "car_park_no": f"B{i}",
+            "address": f"BLK {i} BENCHMARK STREET {i % 97}",
+            "x_coord": f"{rng.uniform(5000, 45000):.4f}",
+            "y_coord": f"{rng.uniform(25000, 48000):.4f}",
+            "car_park_type": rng.choice(["MULTI-STOREY CAR PARK", "SURFACE CAR PARK", "BASEMENT CAR PARK"]),
+            "type_of_parking_system": rng.choice(["ELECTRONIC PARKING", "COUPON PARKING"]),
+            "short_term_parking": "WHOLE DAY",
+            "free_parking": rng.choice(["NO", "SUN & PH FR 7AM-10.30PM"]),
+            "night_parking": rng.choice(["YES", "NO"]),
+            "car_park_decks": str(rng.randint(0, 12)),
+            "gantry_height": f"{rng.choice([0, 1.8, 2.1, 2.15, 4.5]):.2f}",
+            "car_park_basement": rng.choice(["Y", "N"]),
+        })
+    return {"help": "", "success": True, "result": {"resource_id": "bench", "records": records, "total": count}}
+
+def availability_feed(count, round_no):
+    rng = random.Random(count * 1000 + round_no)
+    update_datetime = (datetime(2023, 3, 1, 10) + timedelta(minutes=5 * round_no)).isoformat()
+    data = []
+    for i in range(count):
+        total = rng.randint(50, 800)
+        info = [{"total_lots": str(total), "lot_type": "C", "lots_available": str(rng.randint(0, total))}]
+        if i % 3 == 0:
+            info.append({"total_lots": "40", "lot_type": "Y", "lots_available": str(rng.randint(0, 40))})
+        data.append({"carpark_info": info, "carpark_number": f"B{i}", "update_datetime": update_datetime})
+    return {"items": [{"timestamp": update_datetime, "carpark_data": data}], "api_info": {"status": "healthy"}}
+
+# Serves gzip compressed feeds with an ETag, answering If-None-Match with a 304
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    feeds = {}
+
+    def do_GET(self):
+        body, etag = self.feeds[self.path.split('?')[0]]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve_feed(path, document):
+    raw = json.dumps(document).encode()
+    StubHandler.feeds[path] = (gzip.compress(raw, compresslevel=1), f'"{hashlib.sha1(raw).hexdigest()}"')
+    return len(raw)
+
+class Recorder:
+    def __init__(self, engine, measure_memory):
+        self.engine = engine
+        self.measure_memory = measure_memory
+        self.statements = 0
+        self.results = []
+        event.listen(engine, "before_cursor_execute", self.count)
+
+    def count(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+    # Runs fn `repeat` times and records the mean time, the peak memory and statements per run
+    def measure(self, scale, case, fn, repeat=1):
+        self.statements = 0
+        if self.measure_memory:
+            tracemalloc.start()
+        start = perf_counter()
+        for _ in range(repeat):
+            fn()
+        seconds = (perf_counter() - start) / repeat
+        peak_kb = None
+        if self.measure_memory:
+            peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        result = {
+            'scale': scale,
+            'carparks': scale * CARPARKS,
+            'case': case,
+            'seconds': round(seconds, 6),
+            'peak_kb': peak_kb,
+            'statements': self.statements / repeat,
+            'repeat': repeat,
+        }
+        self.results.append(result)
+        print(f"{scale:>4}x {case:<40} {seconds * 1000:>10.2f} ms {peak_kb if peak_kb is not None else '-':>10} KB"
+              f" {result['statements']:>8g} statements")
+        return result
+
+def setup_users(app, rewards):
+    with app.app_context():
+        driver_user = User(user_type="driver")
+        company_user = User(user_type="corporate")
+        db.session.add_all([driver_user, company_user])
+        db.session.commit()
+        db.session.add(Driver(email="driver@bench.test", first_name="Driver", points=1000, user_id=driver_user.id,
+                              password=generate_password_hash(PASSWORD, method='sha256')))
+        db.session.add(Company(company_name="Bench Co", uen="BENCH1", user_id=company_user.id,
+                               password=generate_password_hash(PASSWORD, method='sha256')))
+        for i in range(rewards):
+            db.session.add(Reward(reward_title=f"Reward {i}", reward_expiry=date.today() + timedelta(days=30),
+                                  reward_category="Food" if i % 2 else "Travel", reward_details="",
+                                  number_of_rewards=10, cost_of_reward=1, user_id=company_user.id))
+        db.session.commit()
+
+def run_scale(scale, base_url, measure_memory):
+    from website.update_carparks import update_carparks, update_carparks_availability, generate_geojson
+
+    count = scale * CARPARKS
+    info_bytes = serve_feed('/info', carpark_info_feed(count))
+    serve_feed('/availability', availability_feed(count, 0))
+    print(f"{scale:>4}x feeds: {count} carparks, {info_bytes // 1024} KB of carpark information")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}",
+            'REFRESH_CARPARKS': False,
+            'TESTING': True,
+            'CARPARK_INFO_URL': f"{base_url}/info",
+            'CARPARK_AVAILABILITY_URL': f"{base_url}/availability",
+        })
+        setup_users(app, rewards=200)
+        with app.app_context():
+            recorder = Recorder(db.engine, measure_memory)
+
+        def in_app_context(fn):
+            def run():
+                with app.app_context():
+                    fn()
+            return run
+
+        recorder.measure(scale, 'update_carparks (insert all)', in_app_context(update_carparks))
+        # Same feed again, but fetched in full to time the diff against the database
+        app.extensions['upstream'].validators.clear()
+        recorder.measure(scale, 'update_carparks (unchanged)', in_app_context(update_carparks))
+        recorder.measure(scale, 'update_carparks_availability (first)', in_app_context(update_carparks_availability))
+        serve_feed('/availability', availability_feed(count, 1))
+        recorder.measure(scale, 'update_carparks_availability (changed)', in_app_context(update_carparks_availability))
+        recorder.measure(scale, 'update_carparks_availability (304)', in_app_context(update_carparks_availability))
+        recorder.measure(scale, 'generate_geojson', in_app_context(generate_geojson))
+        # Both feeds through the staged ingestion pipeline, fetched concurrently
+        serve_feed('/availability', availability_feed(count, 2))
+        app.extensions['upstream'].validators.clear()
+        recorder.measure(scale, 'pipeline (both feeds)', app.extensions['pipeline'].run)
+
+        # Requests must not run inside an outer app context, or they would share current_user
+        driver = app.test_client()
+        driver.post('/login/driver', data={'email': "driver@bench.test", 'password': PASSWORD})
+        response = driver.get('/carparks', headers={'Accept-Encoding': 'gzip'})
+        etag = response.headers['ETag']
+        repeat = max(1, REPEAT // scale)
+
+        recorder.measure(scale, 'GET /carparks (gzip)',
+                         lambda: driver.get('/carparks', headers={'Accept-Encoding': 'gzip'}), repeat)
+        recorder.measure(scale, 'GET /carparks (identity)', lambda: driver.get('/carparks'), repeat)
+        recorder.measure(scale, 'GET /carparks (304)',
+                         lambda: driver.get('/carparks', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag}),
+                         REPEAT)
+        recorder.measure(scale, 'GET /carparks/nearby',
+                         lambda: driver.get('/carparks/nearby?lat=1.35&lon=103.82&radius_km=2&limit=20'), REPEAT)
+        recorder.measure(scale, 'GET /carparks/recommend (city-wide)',
+                         lambda: driver.get('/carparks/recommend?lat=1.35&lon=103.82&radius_km=30&vehicle_height=2'),
+                         REPEAT)
+        recorder.measure(scale, 'GET /carparks/clusters (island)',
+                         lambda: driver.get('/carparks/clusters?bbox=103.6,1.2,104.1,1.5&zoom=11'), REPEAT)
+        recorder.measure(scale, 'GET /rewards', lambda: driver.get('/rewards'), REPEAT)
+
+        addresses = [f"BLK {i} BENCHMARK STREET {i % 97}" for i in range(REPEAT)]
+        recorder.measure(scale, 'PUT /drivers (interested carpark)',
+                         lambda: driver.put('/drivers', json={'intent': "update_interested_carpark",
+                                                              'carpark_address': addresses.pop()}), REPEAT)
+
+        event.remove(recorder.engine, "before_cursor_execute", recorder.count)
+        return recorder.results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+# Prints the change in time of every case that is in both runs
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    before = {(r['scale'], r['case']): r for r in baseline['results']}
+    print(f"\nCompared with {baseline.get('commit')} ({baseline_path}):")
+    for result in results:
+        old = before.get((result['scale'], result['case']))
+        if old is None or not old['seconds']:
+            continue
+        change = (result['seconds'] - old['seconds']) / old['seconds'] * 100
+        print(f"{result['scale']:>4}x {result['case']:<40} {old['seconds'] * 1000:>10.2f} -> "
+              f"{result['seconds'] * 1000:>10.2f} ms ({change:+.0f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for carpark ingestion and the hot endpoints")
+    parser.add_argument('--scales', default="1,10,100", help="comma separated multiples of 2,200 carparks")
+    parser.add_argument('--output', default=None,
+                        help="JSON file to write (default benchmarks/results/<commit>-<UTC time>.json)")
+    parser.add_argument('--force', action='store_true', help="overwrite the --output file if it exists")
+    parser.add_argument('--compare', default=None, help="JSON file of an earlier run to compare with")
+    parser.add_argument('--no-memory', action='store_true', help="don't trace memory allocations")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    created_at = datetime.utcnow()
+    # Every run gets its own file by default, so runs of the same commit don't replace each other
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         f"{commit or 'unknown'}-{created_at.strftime('%Y%m%dT%H%M%S')}.json")
+    # Checked before running, not after minutes of benchmarks
+    if os.path.exists(output) and not args.force:
+        parser.error(f"{output} already exists, use --force to overwrite it")
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    results = []
+    for scale in (int(scale) for scale in args.scales.split(',')):
+        results.extend(run_scale(scale, base_url, not args.no_memory))
+    server.shutdown()
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'created_at': created_at.isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'memory_traced': not args.no_memory,
+            'results': results,
+        }, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Fires concurrent reward claims through the Flask test client and checks that
+# no reward is oversold and no driver spends more points than they have.
+#
+# Run from the repository root:
+#   python benchmarks/stress_claims.py --drivers 20 --claims 10 --stock 50
+import argparse
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash
+from website import create_app, db
+from website.models import User, Driver, Company, Reward, UserClaimedRewards
+
+PASSWORD = "Password1!"
+
+def setup(app, drivers, points, stock, cost):
+    with app.app_context():
+        db.create_all()
+        company = User(user_type="corporate")
+        db.session.add(company)
+        db.session.commit()
+        db.session.add(Company(company_name="Stress Co", uen="STRESS1",
+                               password=generate_password_hash(PASSWORD, method='sha256'), user_id=company.id))
+        reward = Reward(reward_title="Stress reward", reward_expiry=date.today() + timedelta(days=30),
+                        reward_category="Food", reward_details="", number_of_rewards=stock,
+                        cost_of_reward=cost, user_id=company.id)
+        db.session.add(reward)
+
+        for i in range(drivers):
+            user = User(user_type="driver")
+            db.session.add(user)
+            db.session.commit()
+            db.session.add(Driver(email=f"driver{i}@stress.test", first_name=f"Driver {i}",
+                                  password=generate_password_hash(PASSWORD, method='sha256'),
+                                  user_id=user.id, points=points))
+        db.session.commit()
+        return reward.id
+
+def claim_repeatedly(app, driver_no, reward_id, claims):
+    client = app.test_client()
+    client.post('/login/driver', data={'email': f"driver{driver_no}@stress.test", 'password': PASSWORD})
+    errors = 0
+    for _ in range(claims):
+        response = client.post('/rewards/claim', data={'reward_id': reward_id})
+        if response.status_code != 302:
+            errors += 1
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--drivers', type=int, default=20)
+    parser.add_argument('--claims', type=int, default=10, help="claims attempted by each driver")
+    parser.add_argument('--points', type=int, default=50, help="starting points of each driver")
+    parser.add_argument('--stock', type=int, default=50, help="number of rewards available")
+    parser.add_argument('--cost', type=float, default=1.0, help="cost of the reward in dollars")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp_dir, 'stress.db')}",
+            'REFRESH_CARPARKS': False,
+            'TESTING': True,
+        })
+        reward_id = setup(app, args.drivers, args.points, args.stock, args.cost)
+
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=args.drivers) as executor:
+            futures = [executor.submit(claim_repeatedly, app, i, reward_id, args.claims)
+                       for i in range(args.drivers)]
+            errors = sum(future.result() for future in futures)
+        elapsed = perf_counter() - start
+
+        with app.app_context():
+            reward = db.session.get(Reward, reward_id)
+            claimed = UserClaimedRewards.query.filter_by(reward_id=reward_id).count()
+            drivers = Driver.query.all()
+            cost_in_points = args.cost*10
+
+            problems = []
+            if claimed + reward.number_of_rewards != args.stock:
+                problems.append(f"{claimed} claimed + {reward.number_of_rewards} left != {args.stock} stock")
+            if reward.number_of_rewards < 0:
+                problems.append(f"reward oversold, {reward.number_of_rewards} left")
+            for driver in drivers:
+                driver_claims = UserClaimedRewards.query.filter_by(driver_user_id=driver.user_id).count()
+                if driver.points < 0 or driver.points != args.points - driver_claims*cost_in_points:
+                    problems.append(f"{driver.email} has {driver.points} points after {driver_claims} claims")
+
+        attempts = args.drivers*args.claims
+        print(f"{attempts} claims attempted by {args.drivers} drivers in {elapsed:.2f}s "
+              f"({attempts/elapsed:.0f} claims/s), {claimed} succeeded, {errors} errors")
+        for problem in problems:
+            print(f"FAILED: {problem}")
+        return 1 if problems or errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,7 +6,7 @@ app = create_app()
 
 if __name__ == '__main__':
     # Threading doesn't work well with reloader especially on Windows
-    # If you want the reloader, comment out the line below and and
-    # t1.start() t2.start() in __init__.py
+    # If you want the reloader, comment out the line below and pass
+    # {'REFRESH_CARPARKS': False} to create_app() above
     app.run(debug=True, use_reloader=False)
     #app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,36 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from website import create_app
+
+# An app with its own empty SQLite database and no background jobs
+@pytest.fixture
+def app(tmp_path):
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'REFRESH_CARPARKS': False,
+        'TESTING': True,
+    })
+
+PASSWORD = "Password1!"
+
+# A test client logged in as a driver
+@pytest.fixture
+def driver(app):
+    from werkzeug.security import generate_password_hash
+    from website import db
+    from website.models import User, Driver
+
+    with app.app_context():
+        user = User(user_type="driver")
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(Driver(email="driver@test.test", first_name="Driver", points=0, user_id=user.id,
+                              password=generate_password_hash(PASSWORD, method='sha256')))
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login/driver', data={'email': "driver@test.test", 'password': PASSWORD})
+    return client
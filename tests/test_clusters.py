@@ -0,0 +1,70 @@
+import math
+
+import pytest
+from website.clusters import ClusterIndex, MAX_ZOOM, lat_to_y, level_for
+
+def feature(car_park_no, lon, lat, total_lots=10, lots_available=5):
+    return {'car_park_no': car_park_no, 'coordinates': [lon, lat], 'total_lots': total_lots,
+            'lots_available': lots_available, 'no_of_interested_drivers': 0}
+
+@pytest.fixture
+def features():
+    # Two carparks next to each other in Singapore and one far away from them
+    return [feature("A", 103.8, 1.3), feature("B", 103.8001, 1.3001), feature("C", 100.0, 5.0)]
+
+def get_clusters(features, bbox, zoom):
+    index = ClusterIndex(features)
+    by_number = {f['car_park_no']: f for f in features}
+    return index.get_clusters(by_number, index.aggregate(by_number), bbox, zoom)
+
+def carparks_in(results):
+    return sum(r['point_count'] if r.get('cluster') else 1 for r in results)
+
+def test_poles_are_clamped():
+    assert lat_to_y(90) == lat_to_y(85.05113) == 0
+    assert lat_to_y(-90) == lat_to_y(-85.05113) == 1
+    assert 0 < lat_to_y(1.3) < 1
+
+def test_whole_world_bbox(features):
+    for zoom in (0, 5, MAX_ZOOM + 1):
+        assert carparks_in(get_clusters(features, (-180, -90, 180, 90), zoom)) == 3
+
+def test_bbox_outside_the_carparks(features):
+    assert get_clusters(features, (0, 50, 10, 60), 10) == []
+    assert get_clusters(features, (103.79, 1.29, 103.79, 1.29), 10) == []
+
+def test_zoom_out_of_range_is_clamped(features):
+    bbox = (103.7, 1.2, 103.9, 1.4)
+    assert get_clusters(features, bbox, -3) == get_clusters(features, bbox, 0)
+    assert get_clusters(features, bbox, 40) == get_clusters(features, bbox, MAX_ZOOM + 1)
+    assert get_clusters(features, bbox, math.inf) == get_clusters(features, bbox, MAX_ZOOM + 1)
+    assert level_for(12.7) == 12
+
+def test_nearby_carparks_cluster_when_zoomed_out(features):
+    bbox = (103.7, 1.2, 103.9, 1.4)
+    zoomed_out = get_clusters(features, bbox, 5)
+    assert len(zoomed_out) == 1 and zoomed_out[0]['point_count'] == 2
+    assert zoomed_out[0]['total_lots'] == 20 and zoomed_out[0]['lots_available'] == 10
+    zoomed_in = get_clusters(features, bbox, MAX_ZOOM + 1)
+    assert sorted(r['car_park_no'] for r in zoomed_in) == ["A", "B"]
+
+@pytest.mark.parametrize('query', [
+    'bbox=-180,-90,180,90&zoom=3',
+    'bbox=-180,-90,180,90&zoom=1e9',
+    'bbox=-180,-90,180,90&zoom=-1e9',
+])
+def test_clusters_route_edge_values(driver, query):
+    response = driver.get(f'/carparks/clusters?{query}')
+    assert response.status_code == 200
+
+@pytest.mark.parametrize('query', [
+    'bbox=103.6,1.2,104.1,1.5&zoom=nan',
+    'bbox=103.6,1.2,104.1,1.5&zoom=inf',
+    'bbox=103.6,1.2,104.1,1.5&zoom=-inf',
+    'bbox=103.6,nan,104.1,1.5&zoom=3',
+    'bbox=103.6,1.2,inf,1.5&zoom=3',
+    'bbox=103.6,1.2,104.1&zoom=3',
+])
+def test_clusters_route_rejects_non_finite_values(driver, query):
+    response = driver.get(f'/carparks/clusters?{query}')
+    assert response.status_code == 400
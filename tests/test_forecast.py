@@ -0,0 +1,35 @@
+import pytest
+from website import forecast as forecasts
+from website.forecast import get_forecaster, observe_availability, rebuild_forecaster, time_bucket, Forecaster
+
+NOW = 1_700_000_000
+
+def features(lots_available):
+    return [{'car_park_no': "A", 'lots': {'C': [10, lots_available]}}]
+
+def typical(forecaster, now):
+    return forecaster.typical_lots_available("A", time_bucket(now))
+
+def test_observations_made_during_a_rebuild_are_replayed(monkeypatch):
+    # Another refresh observes the tables being replaced while the new ones are built
+    def build_forecaster():
+        observe_availability(features(4), now=NOW)
+        return Forecaster()
+    monkeypatch.setattr(forecasts, 'build_forecaster', build_forecaster)
+
+    forecaster = rebuild_forecaster()
+    assert get_forecaster() is forecaster
+    assert typical(forecaster, NOW) == 4
+
+    observe_availability(features(6), now=NOW + 300)
+    assert typical(forecaster, NOW + 300) == pytest.approx(4 + forecasts.ALPHA * 2)
+
+def test_samples_already_in_the_history_are_not_replayed(monkeypatch):
+    def build_forecaster():
+        observe_availability(features(4), now=NOW)
+        forecaster = Forecaster()
+        forecaster.observe_features(features(8), NOW)
+        return forecaster
+    monkeypatch.setattr(forecasts, 'build_forecaster', build_forecaster)
+
+    assert typical(rebuild_forecaster(), NOW) == 8
@@ -0,0 +1,87 @@
+# Runs the hot driver and corporate routes through the Flask test client, records every
+# SQL statement they send and checks with EXPLAIN QUERY PLAN that each one uses an index.
+# A full table scan is only accepted when the statement has a LIMIT (e.g. the first
+# page of rewards, read in primary key order).
+#
+# Run from the repository root:
+#   python -m pytest tests
+from datetime import date, timedelta
+
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from website import db
+from website.models import User, Driver, Company, Vehicle, Reward, CarPark
+
+PASSWORD = "Password1!"
+
+def setup(app):
+    with app.app_context():
+        driver_user = User(user_type="driver")
+        company_user = User(user_type="corporate")
+        db.session.add_all([driver_user, company_user])
+        db.session.commit()
+        db.session.add(Driver(email="driver@plans.test", first_name="Driver", points=1000, user_id=driver_user.id,
+                              password=generate_password_hash(PASSWORD, method='sha256')))
+        db.session.add(Company(company_name="Plans Co", uen="PLANS1", user_id=company_user.id,
+                               password=generate_password_hash(PASSWORD, method='sha256')))
+        db.session.add(Vehicle(full_name="Driver", car_plate="SAA1234A", user_id=driver_user.id,
+                               coe_expiry=date.today() + timedelta(days=365)))
+        for i in range(50):
+            db.session.add(Reward(reward_title=f"Reward {i}", reward_expiry=date.today() + timedelta(days=30),
+                                  reward_category="Food" if i % 2 else "Travel", reward_details="",
+                                  number_of_rewards=10, cost_of_reward=1, user_id=company_user.id))
+            db.session.add(CarPark(car_park_no=f"P{i}", address=f"Block {i}", latitude=1.3, longitude=103.8,
+                                   total_lots=10, lots_available=5, no_of_interested_drivers=0))
+        db.session.commit()
+
+def exercise_routes(app):
+    driver = app.test_client()
+    driver.post('/login/driver', data={'email': "driver@plans.test", 'password': PASSWORD})
+    driver.get('/map')
+    driver.get('/rewards')
+    driver.get('/rewards?category=Food&after=10')
+    driver.post('/rewards/claim', data={'reward_id': 5})
+    driver.delete('/rewards/use', json={'rewardId': 5})
+    driver.post('/coe', data={'fullName': "Driver", 'carPlate': "SBB2345B",
+                              'coeExpiry': (date.today() + timedelta(days=365)).isoformat()})
+    driver.get('/coe/registered_vehicles')
+    driver.put('/drivers', json={'intent': "update_interested_carpark", 'carpark_address': "Block 7"})
+    driver.put('/points', json={'points_change': 1})
+    driver.get('/carparks/P7/history?hours=48')
+
+    company = app.test_client()
+    company.post('/login/corporate', data={'uen': "PLANS1", 'password': PASSWORD})
+    company.get('/rewards')
+
+# Returns the distinct (statement, parameters) the routes sent, in the order they were first sent
+def record_statements(app):
+    statements = {}
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            statements.setdefault(statement, parameters)
+
+    with app.app_context():
+        engine = db.engine
+    # Requests must not run inside an outer app context, or they would share `g` (and current_user)
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        exercise_routes(app)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    return list(statements.items())
+
+def test_hot_routes_use_an_index(app):
+    setup(app)
+    statements = record_statements(app)
+    assert statements
+
+    problems = []
+    with app.app_context():
+        with db.engine.connect() as conn:
+            for statement, parameters in statements:
+                plan = [row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+                full_scans = [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step]
+                if full_scans and 'LIMIT' not in statement.upper():
+                    problems.append(f"{' '.join(statement.split())}\n    " + '\n    '.join(plan))
+
+    assert not problems, f"{len(problems)} of {len(statements)} statements scan a whole table:\n" + '\n'.join(problems)
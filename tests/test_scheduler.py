@@ -0,0 +1,30 @@
+from website.scheduler import Scheduler, LEADER_RETRY_INTERVAL
+
+class HeldLock:
+    def acquire(self):
+        return False
+
+# Runs the job forever, recording each wait instead of waiting
+def run(app, interval, lock, waits=3):
+    scheduler = Scheduler(app)
+    job = scheduler.add_job('job', interval, lambda: None)
+    job.lock = lock
+    job.is_leader = lock is None
+    delays = []
+    def wait(delay):
+        delays.append(delay)
+        if len(delays) == waits:
+            scheduler.stop()
+    scheduler.stopped.wait = wait
+    scheduler.run_job_forever(job)
+    return job, delays
+
+def test_followers_retry_the_lock_whatever_the_interval(app):
+    job, delays = run(app, 60*60*24, HeldLock())
+    assert delays == [LEADER_RETRY_INTERVAL] * 3
+    assert job.runs == 0 and job.skipped == 3
+
+def test_leader_waits_for_the_interval(app):
+    job, delays = run(app, 60*60*24, None)
+    assert all(delay > 60*60*23 for delay in delays)
+    assert job.runs == 3
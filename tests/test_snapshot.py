@@ -0,0 +1,105 @@
+import pytest
+from website import snapshot as snapshots
+from website.snapshot import (get_changes_since, get_snapshot, publish_snapshot, version_token,
+                              patch_snapshot_feature, flush_snapshot_patches)
+
+def feature(car_park_no, lots_available=5, interested=0):
+    return {'car_park_no': car_park_no, 'coordinates': [103.8, 1.3], 'total_lots': 10,
+            'lots_available': lots_available, 'vacancy_percentage': lots_available * 10,
+            'no_of_interested_drivers': interested, 'lots': {'C': [10, lots_available]}}
+
+# Publishes each list of features in turn, starting from a known one
+# Returns the version token of the starting snapshot
+def publish(*versions):
+    start = publish_snapshot([feature("A"), feature("B"), feature("C")])
+    for features in versions:
+        publish_snapshot(features)
+    return start.token
+
+def test_same_version_has_no_changes():
+    token = publish()
+    assert get_changes_since(token) == {'version': token, 'changed': [], 'added': [], 'removed': []}
+
+def test_changes_of_a_carpark_are_merged_into_the_latest():
+    since = publish([feature("A", 4), feature("B"), feature("C")],
+                    [feature("A", 3), feature("B", interested=1), feature("C")])
+    changes = get_changes_since(since)
+    assert changes['version'] == get_snapshot().token
+    changed = {change['car_park_no']: change for change in changes['changed']}
+    assert changed.keys() == {"A", "B"}
+    assert changed["A"]['lots_available'] == 3
+    assert changed["B"]['no_of_interested_drivers'] == 1
+    assert changes['added'] == [] and changes['removed'] == []
+
+def test_changes_to_an_added_carpark_are_merged_into_it():
+    since = publish([feature("A"), feature("B"), feature("C"), feature("D", 8)],
+                    [feature("A"), feature("B"), feature("C"), feature("D", 2)])
+    changes = get_changes_since(since)
+    assert [f['car_park_no'] for f in changes['added']] == ["D"]
+    assert changes['added'][0]['lots_available'] == 2
+    assert changes['changed'] == [] and changes['removed'] == []
+
+def test_added_then_removed_carpark_is_left_out():
+    since = publish([feature("A"), feature("B"), feature("C"), feature("D")],
+                    [feature("A"), feature("B"), feature("C")])
+    changes = get_changes_since(since)
+    assert changes['added'] == [] and changes['removed'] == [] and changes['changed'] == []
+
+def test_changed_then_removed_carpark_is_only_removed():
+    since = publish([feature("A", 1), feature("B"), feature("C")],
+                    [feature("B"), feature("C")])
+    changes = get_changes_since(since)
+    assert changes['removed'] == ["A"] and changes['changed'] == []
+
+def test_removed_then_added_back_carpark_is_added():
+    since = publish([feature("B"), feature("C")],
+                    [feature("A", 7), feature("B"), feature("C")])
+    changes = get_changes_since(since)
+    assert changes['removed'] == []
+    assert [(f['car_park_no'], f['lots_available']) for f in changes['added']] == [("A", 7)]
+
+@pytest.mark.parametrize('make_token', [
+    lambda version: f"00000000:{version}",          # another process
+    lambda version: str(version),                   # no epoch
+    lambda version: version_token(version + 1),     # newer than this process has
+    lambda version: version_token(version - snapshots.MAX_CHANGE_HISTORY - 5),  # too old
+    lambda version: f"{snapshots.get_epoch()}:x",
+])
+def test_unknown_versions_need_a_full_refetch(make_token):
+    publish()
+    for _ in range(snapshots.MAX_CHANGE_HISTORY + 10):
+        publish_snapshot([feature("A"), feature("B"), feature("C")])
+    assert get_changes_since(make_token(get_snapshot().version)) is None
+
+def test_epoch_changes_after_a_fork(monkeypatch):
+    token = publish()
+    monkeypatch.setattr(snapshots.os, 'getpid', lambda: -1)
+    assert get_changes_since(token) is None
+
+def test_interest_patches_are_published_together():
+    since = publish()
+    version = get_snapshot().version
+    assert patch_snapshot_feature("A", no_of_interested_drivers=1)['no_of_interested_drivers'] == 1
+    assert patch_snapshot_feature("A", no_of_interested_drivers=2)['no_of_interested_drivers'] == 2
+    assert patch_snapshot_feature("B", no_of_interested_drivers=1)['lots_available'] == 5
+    assert patch_snapshot_feature("Z", no_of_interested_drivers=1) is None
+    # Nothing is published until the flush
+    assert get_snapshot().version == version
+
+    snapshot = flush_snapshot_patches()
+    assert snapshot.version == version + 1 and get_snapshot() is snapshot
+    assert snapshot.by_number["A"]['no_of_interested_drivers'] == 2
+    assert snapshot._encoded and snapshot._cluster_sums is not None
+    changed = {change['car_park_no']: change for change in get_changes_since(since)['changed']}
+    assert {no: change['no_of_interested_drivers'] for no, change in changed.items()} == {"A": 2, "B": 1}
+    assert flush_snapshot_patches() is None
+
+def test_changes_older_than_the_history_need_a_full_refetch(monkeypatch):
+    now = snapshots.time()
+    since = publish([feature("A", 3), feature("B"), feature("C")])
+    monkeypatch.setattr(snapshots, 'time', lambda: now + snapshots.CHANGE_HISTORY_SECONDS - 1)
+    recent = publish_snapshot([feature("A", 1), feature("B"), feature("C")]).token
+    monkeypatch.setattr(snapshots, 'time', lambda: now + snapshots.CHANGE_HISTORY_SECONDS + 1)
+    publish_snapshot([feature("A", 2), feature("B"), feature("C")])
+    assert get_changes_since(since) is None
+    assert [change['lots_available'] for change in get_changes_since(recent)['changed']] == [2]
@@ -0,0 +1,68 @@
+from website import db
+from website.models import CarPark
+from website.snapshot import get_snapshot
+from website.update_carparks import (update_carparks, refresh_snapshot_if_stale, bump_carpark_generation,
+                                     KEYS_IN_ORDER)
+from website.views import change_interested_drivers
+
+def carpark_record(i):
+    values = {
+        'car_park_no': f"T{i}", 'address': f"BLK {i} TEST STREET", 'x_coord': f"{30000 + i * 10}",
+        'y_coord': f"{35000 + i * 10}", 'car_park_type': "SURFACE CAR PARK",
+        'type_of_parking_system': "ELECTRONIC PARKING", 'short_term_parking': "WHOLE DAY",
+        'free_parking': "NO", 'night_parking': "YES", 'car_park_decks': "0", 'gantry_height': "2.15",
+        'car_park_basement': "N",
+    }
+    return [values[key] for key in KEYS_IN_ORDER]
+
+def deleted_carparks():
+    return db.session.execute(db.select(CarPark.car_park_no).where(CarPark.is_deleted)).scalars().all()
+
+def test_empty_feed_deletes_nothing(app):
+    with app.app_context():
+        update_carparks(records=iter([carpark_record(i) for i in range(5)]))
+        version = get_snapshot().version
+
+        stats = update_carparks(records=iter([]))
+
+        assert stats['incomplete'] and stats['deleted'] == 0
+        assert deleted_carparks() == []
+        assert get_snapshot().version == version
+
+def test_short_feed_deletes_nothing(app):
+    with app.app_context():
+        update_carparks(records=iter([carpark_record(i) for i in range(20)]))
+
+        stats = update_carparks(records=iter([carpark_record(i) for i in range(10)]))
+
+        assert stats['incomplete'] and deleted_carparks() == []
+
+def test_carparks_missing_from_a_full_feed_are_deleted(app):
+    with app.app_context():
+        update_carparks(records=iter([carpark_record(i) for i in range(20)]))
+
+        stats = update_carparks(records=iter([carpark_record(i) for i in range(1, 20)]))
+
+        assert not stats.get('incomplete') and stats['deleted'] == 1
+        assert deleted_carparks() == ["T0"]
+
+def test_followers_rebuild_after_any_carpark_write(app):
+    with app.app_context():
+        update_carparks(records=iter([carpark_record(i) for i in range(20)]))
+        db.session.execute(db.update(CarPark).values(total_lots=10, lots_available=5))
+        bump_carpark_generation()
+        db.session.commit()
+        assert refresh_snapshot_if_stale() is not None
+        assert refresh_snapshot_if_stale() is None
+
+        # Interested drivers, as written by another worker
+        change_interested_drivers("T3", 1)
+        db.session.commit()
+        snapshot = refresh_snapshot_if_stale()
+        assert snapshot.by_number["T3"]['no_of_interested_drivers'] == 1
+
+        # Master data and tombstones
+        update_carparks(records=iter([carpark_record(i) for i in range(1, 20)]), publish=False)
+        snapshot = refresh_snapshot_if_stale()
+        assert "T0" not in snapshot.by_number
+        assert refresh_snapshot_if_stale() is None
@@ -1,26 +1,41 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+import logging
 import os
 from flask_login import LoginManager
-from .update_carparks import update_carparks, update_carparks_availability, generate_geojson
-from time import sleep
-from threading import Thread, active_count
+from .update_carparks import refresh_snapshot_if_stale
+from .snapshot import load_snapshot
+from .database import get_database_url, default_database_config, get_engine_options, configure_engine
+from .scheduler import Scheduler
+from .forecast import rebuild_forecaster
+from .upstream import UpstreamClient, default_upstream_config
+from .pipeline import IngestionPipeline
+from .metrics import init_metrics, default_metrics_config
+from .events import default_events_config
 
 db = SQLAlchemy()
 DB_NAME = "database.db"
 
-def do_with_app_context_periodically(app, interval, target, args=None, kwargs=None):
-    args = args or []
-    kwargs = kwargs or {}
-    while True:
-        with app.app_context():
-            target(*args, **kwargs)
-        sleep(interval)
-
-def create_app():
+# config overrides the defaults below, e.g. to use another database in scripts
+def create_app(config=None):
     app = Flask(__name__)
+    # The modules log to loggers under app.logger ("website.update_carparks", ...), the status
+    # of every refresh is logged at INFO
+    if not app.logger.level:
+        app.logger.setLevel(logging.INFO)
     app.config['SECRET_KEY'] = os.urandom(24)
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_NAME}'
+    app.config['SQLALCHEMY_DATABASE_URI'] = get_database_url(f'sqlite:///{DB_NAME}')
+    app.config.update(default_database_config())
+    app.config.update(default_upstream_config())
+    app.config.update(default_metrics_config())
+    app.config.update(default_events_config())
+    # Optional file the carpark snapshot is persisted to, so a restart can serve it immediately
+    app.config['CARPARKS_JSON_PATH'] = os.getenv('CARPARKS_JSON_PATH')
+    # Set to False to not fetch carpark data from data.gov.sg in the background
+    app.config['REFRESH_CARPARKS'] = True
+    if config:
+        app.config.update(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', get_engine_options(app.config))
     db.init_app(app)
     
     from .views import views
@@ -29,31 +44,48 @@ def create_app():
     app.register_blueprint(views, url_prefix='/')
     app.register_blueprint(auth, url_prefix='/')
 
-    from .models import User
+    from .identity import load_identity
+    from .migrations import run_migrations
 
     with app.app_context():
+        configure_engine(app, db)
+        # Request latency, SQL counts and the /metrics endpoint
+        init_metrics(app, db.engine)
         db.create_all()
+        run_migrations(db.engine)
+
+    load_snapshot(app.config['CARPARKS_JSON_PATH'])
+    # Keep-alive connections to data.gov.sg shared by the refresh jobs
+    app.extensions.setdefault('upstream', UpstreamClient.from_config(app.config))
 
-    def f():
-        update_carparks_availability()
-        generate_geojson()
+    # Fetch, parse, write and publish stages for both feeds, see pipeline.py
+    # The snapshot is only rebuilt if the availability changed (or was never published by this process)
+    pipeline = IngestionPipeline(app)
+    app.extensions['pipeline'] = pipeline
 
-    t1 = Thread(target=do_with_app_context_periodically, args=(app, 60*60*24, update_carparks))
-    t1.daemon = True
-    t2 = Thread(target=do_with_app_context_periodically, args=(app, 60*5, f))
-    t2.daemon = True
+    # Only one process per host (the one holding the job's lock file in the instance
+    # folder) fetches from data.gov.sg, the others rebuild their snapshot from the
+    # database once the leader has written new availability
+    scheduler = Scheduler(app)
+    scheduler.add_job('update_carparks', 60*60*24, lambda: pipeline.run('carparks'), leader_only=True)
+    scheduler.add_job('update_carparks_availability', 60*5, lambda: pipeline.run('availability'), leader_only=True)
+    scheduler.add_job('refresh_snapshot', 60, refresh_snapshot_if_stale)
+    # Every process keeps its own forecast tables, rebuilt from the history once a day
+    scheduler.add_job('rebuild_forecaster', 60*60*24, rebuild_forecaster)
+    # Per job stats (last run, duration, errors) are available from scheduler.stats()
+    app.extensions['scheduler'] = scheduler
 
-    # Comment this out if you want
-    t1.start()
-    t2.start()
+    if app.config['REFRESH_CARPARKS']:
+        scheduler.start()
     
     login_manager = LoginManager()
     login_manager.login_view = 'auth.get_driver_login'
     login_manager.init_app(app)
 
+    # current_user is a cached Identity (user + driver/company + has_vehicle), see identity.py
     @login_manager.user_loader
     def load_user(id):
-        return User.query.get(int(id)) #telling flask how we load a user
+        return load_identity(int(id)) #telling flask how we load a user
 
     return app
  
\ No newline at end of file
@@ -0,0 +1,162 @@
+import math
+from bisect import bisect_left, bisect_right
+
+# Point clustering for the map, done once per snapshot instead of in every browser
+# Works like supercluster: carparks are projected to Web Mercator and, from the most
+# zoomed in level down to MIN_ZOOM, every point or cluster within RADIUS pixels of
+# another one is merged into a cluster at their weighted centre. The hierarchy only
+# depends on the coordinates, the lots and interested drivers of each cluster are
+# summed per snapshot by ClusterIndex.aggregate().
+MIN_ZOOM = 0
+MAX_ZOOM = 16       # from MAX_ZOOM + 1 on, every carpark is shown on its own
+RADIUS = 40         # cluster radius in pixels
+EXTENT = 512        # tile size in pixels
+# Web Mercator ends here, the poles themselves would be infinitely far away
+MAX_LATITUDE = 85.05113
+
+def lon_to_x(lon):
+    return lon / 360 + 0.5
+
+def lat_to_y(lat):
+    sin = math.sin(math.radians(min(max(lat, -MAX_LATITUDE), MAX_LATITUDE)))
+    y = 0.5 - 0.25 * math.log((1 + sin) / (1 - sin)) / math.pi
+    return min(max(y, 0), 1)
+
+def x_to_lon(x):
+    return (x - 0.5) * 360
+
+def y_to_lat(y):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+
+# Returns the level to use for a map zoom, which can be fractional or out of range
+# zoom has to be finite
+def level_for(zoom):
+    return int(min(max(zoom, MIN_ZOOM), MAX_ZOOM + 1))
+
+# The clusters of one zoom level, sorted by x so that a bounding box is a bisect away
+# children holds indexes into the next (more zoomed in) level, or the car_park_no
+# on the level where every carpark is its own point
+class ClusterLevel:
+    __slots__ = ('xs', 'ys', 'counts', 'children')
+
+    def __init__(self, nodes):
+        nodes.sort(key=lambda node: node[0])
+        self.xs = [node[0] for node in nodes]
+        self.ys = [node[1] for node in nodes]
+        self.counts = [node[2] for node in nodes]
+        self.children = [node[3] for node in nodes]
+
+    def in_bbox(self, min_x, min_y, max_x, max_y):
+        start = bisect_left(self.xs, min_x)
+        end = bisect_right(self.xs, max_x)
+        ys = self.ys
+        return [i for i in range(start, end) if min_y <= ys[i] <= max_y]
+
+class ClusterIndex:
+    def __init__(self, features):
+        leaves = []
+        for feature in features:
+            lon, lat = feature['coordinates']
+            if lon is not None and lat is not None:
+                leaves.append((lon_to_x(lon), lat_to_y(lat), 1, feature['car_park_no']))
+        self.levels = {MAX_ZOOM + 1: ClusterLevel(leaves)}
+        for zoom in range(MAX_ZOOM, MIN_ZOOM - 1, -1):
+            self.levels[zoom] = self.cluster(self.levels[zoom + 1], zoom)
+
+    @staticmethod
+    def cluster(level, zoom):
+        r = RADIUS / (EXTENT * 2 ** zoom)
+        r2 = r * r
+        xs, ys, counts = level.xs, level.ys, level.counts
+
+        # Points bucketed in cells of the cluster radius, only neighbouring cells are searched
+        grid = {}
+        for i in range(len(xs)):
+            grid.setdefault((int(xs[i] / r), int(ys[i] / r)), []).append(i)
+
+        visited = [False] * len(xs)
+        nodes = []
+        for i in range(len(xs)):
+            if visited[i]:
+                continue
+            visited[i] = True
+            x, y = xs[i], ys[i]
+            count = counts[i]
+            wx, wy = x * count, y * count
+            members = [i]
+            cx, cy = int(x / r), int(y / r)
+            for gx in (cx - 1, cx, cx + 1):
+                for gy in (cy - 1, cy, cy + 1):
+                    for j in grid.get((gx, gy), ()):
+                        if visited[j] or (xs[j] - x) ** 2 + (ys[j] - y) ** 2 > r2:
+                            continue
+                        visited[j] = True
+                        wx += xs[j] * counts[j]
+                        wy += ys[j] * counts[j]
+                        count += counts[j]
+                        members.append(j)
+            nodes.append((wx / count, wy / count, count, members))
+        return ClusterLevel(nodes)
+
+    # Sums (total_lots, lots_available, no_of_interested_drivers) of every cluster, from
+    # the carparks up. Returns zoom -> list of sums in the order of that level's nodes.
+    def aggregate(self, by_number):
+        leaf_level = self.levels[MAX_ZOOM + 1]
+        sums = {MAX_ZOOM + 1: []}
+        for car_park_no in leaf_level.children:
+            feature = by_number.get(car_park_no)
+            if feature is None:
+                sums[MAX_ZOOM + 1].append((0, 0, 0))
+            else:
+                sums[MAX_ZOOM + 1].append((feature['total_lots'] or 0, feature['lots_available'] or 0,
+                                           feature['no_of_interested_drivers'] or 0))
+        for zoom in range(MAX_ZOOM, MIN_ZOOM - 1, -1):
+            below = sums[zoom + 1]
+            level_sums = []
+            for members in self.levels[zoom].children:
+                total_lots = lots_available = interested = 0
+                for j in members:
+                    t, a, n = below[j]
+                    total_lots += t
+                    lots_available += a
+                    interested += n
+                level_sums.append((total_lots, lots_available, interested))
+            sums[zoom] = level_sums
+        return sums
+
+    # Follows a cluster down until it splits (or reaches a single carpark)
+    # Returns the zoom at which it splits and the carpark if it never does
+    def expand(self, zoom, i):
+        while zoom <= MAX_ZOOM:
+            members = self.levels[zoom].children[i]
+            if len(members) > 1:
+                return zoom + 1, None
+            zoom, i = zoom + 1, members[0]
+        return zoom, self.levels[zoom].children[i]
+
+    # Returns what to draw inside bbox (min lon, min lat, max lon, max lat) at the zoom:
+    # the snapshot feature of lone carparks, and a summary of every cluster
+    def get_clusters(self, by_number, sums, bbox, zoom):
+        zoom = level_for(zoom)
+        min_lon, min_lat, max_lon, max_lat = bbox
+        level = self.levels[zoom]
+        results = []
+        for i in level.in_bbox(lon_to_x(min_lon), lat_to_y(max_lat), lon_to_x(max_lon), lat_to_y(min_lat)):
+            if level.counts[i] == 1:
+                feature = by_number.get(self.expand(zoom, i)[1])
+                if feature is not None:
+                    results.append(feature)
+                continue
+            total_lots, lots_available, interested = sums[zoom][i]
+            results.append({
+                'cluster': True,
+                'cluster_id': f"{zoom}-{i}",
+                'coordinates': [x_to_lon(level.xs[i]), y_to_lat(level.ys[i])],
+                'point_count': level.counts[i],
+                'total_lots': total_lots,
+                'lots_available': lots_available,
+                'vacancy_percentage': int((lots_available/total_lots)*100) if total_lots else 0,
+                'no_of_interested_drivers': interested,
+                'expansion_zoom': self.expand(zoom, i)[0],
+            })
+        return results
@@ -0,0 +1,126 @@
+import json
+import os
+from collections import deque
+from itertools import count
+from threading import Condition
+
+# Seconds between keep-alive comments on an idle stream, so proxies don't close it
+HEARTBEAT_INTERVAL = 15
+
+# Number of events kept for clients that are slow to read them
+# A client that falls further behind is told to refetch instead
+MAX_BUFFERED_EVENTS = 100
+
+# Streams a worker holds at most, with OS threads and with green threads (gevent)
+MAX_EVENT_STREAMS = 50
+MAX_GREEN_EVENT_STREAMS = 5000
+
+# True when gevent has patched threading, e.g. under gunicorn -k gevent. A stream then
+# only holds a greenlet blocked on the broker's condition, not an OS thread.
+def green_threads():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+def default_events_config():
+    default = MAX_GREEN_EVENT_STREAMS if green_threads() else MAX_EVENT_STREAMS
+    return {
+        # With OS threads every open stream holds one for as long as the client stays
+        # connected, so keep this well under the threads of the worker (e.g. gunicorn
+        # --threads) or streams would starve the other requests. Clients over the limit
+        # get a 503, which closes their EventSource, and poll /carparks/changes instead
+        # until they try again (see subscribeToCarparkChanges in carpark.js).
+        'MAX_EVENT_STREAMS': int(os.getenv('MAX_EVENT_STREAMS', default)),
+    }
+
+# Fans out carpark change events to every connected map client
+# All clients read from one shared buffer and only remember the sequence number
+# of the last event they sent, so an idle client costs a blocked thread and nothing else
+# There is one broker per worker process, fed by the snapshots that process publishes.
+# A change written by another worker (e.g. an interest click) reaches these clients once
+# this worker's refresh_snapshot job picks it up from the database.
+class CarparkEventBroker:
+    def __init__(self, max_events=MAX_BUFFERED_EVENTS):
+        self.events = deque(maxlen=max_events)
+        self.condition = Condition()
+        self.sequence = count(1)
+        self.last_sequence = 0
+        self.subscribers = 0
+        self.rejected = 0
+
+    # changes is a list of (coordinates, change) pairs
+    def publish(self, version, since, changes, full_refetch=False):
+        with self.condition:
+            self.last_sequence = next(self.sequence)
+            self.events.append((self.last_sequence, version, since, changes, full_refetch))
+            self.condition.notify_all()
+
+    # Returns the events after `sequence` (waiting up to timeout seconds for one)
+    # and whether some events were already dropped from the buffer
+    def wait_for_events(self, sequence, timeout):
+        with self.condition:
+            if self.last_sequence <= sequence:
+                self.condition.wait(timeout)
+            events = [event for event in self.events if event[0] > sequence]
+            missed = bool(events) and events[0][0] > sequence + 1
+            return events, missed
+
+    # Takes one of the `limit` streams for a client, returns False if they are all taken
+    # Every successful call has to be matched by an unsubscribe() once the stream closes
+    def subscribe(self, limit=None):
+        with self.condition:
+            if limit is not None and self.subscribers >= limit:
+                self.rejected += 1
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    # Generator of server-sent events for one client
+    # bbox is (min_lon, min_lat, max_lon, max_lat), or None for every carpark
+    def stream(self, bbox=None, catch_up=None):
+        with self.condition:
+            sequence = self.last_sequence
+        yield "retry: 5000\n\n"
+        if catch_up is not None:
+            yield format_event(catch_up)
+
+        while True:
+            events, missed = self.wait_for_events(sequence, HEARTBEAT_INTERVAL)
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+
+            sequence = events[-1][0]
+            if missed:
+                yield format_event({'version': events[-1][1], 'full_refetch': True}, events[-1][1])
+                continue
+
+            for _, version, since, changes, full_refetch in events:
+                visible = [change for coordinates, change in changes if in_bbox(coordinates, bbox)]
+                if visible or full_refetch:
+                    yield format_event({'version': version, 'since': since,
+                                        'full_refetch': full_refetch, 'changed': visible}, version)
+
+def in_bbox(coordinates, bbox):
+    if bbox is None:
+        return True
+    lon, lat = coordinates
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return min_lon <= lon <= max_lon and min_lat <= lat <= max_lat
+
+def format_event(data, event_id=None):
+    lines = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{lines}data: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+broker = CarparkEventBroker()
+
+# Called whenever a new snapshot is published
+def publish_snapshot_changes(old, new, changed, added, removed):
+    changes = [(new.by_number[car_park_no]['coordinates'], change) for car_park_no, change in changed.items()]
+    broker.publish(new.token, old.token, changes, full_refetch=bool(added or removed))
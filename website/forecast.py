@@ -0,0 +1,193 @@
+import logging
+from array import array
+from math import isnan
+from threading import Lock
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# Typical availability of every carpark by weekday and time of day, used to guess how
+# many lots will be free when a driver arrives rather than when the data was fetched.
+# For each lot type there is one flat table of floats with BUCKETS entries per carpark
+# (7 weekdays * 48 half hours), each an exponentially weighted mean of the lots
+# available in that half hour. Tables are built from the availability history by
+# build_forecaster() and then updated after every refresh by observe_availability(),
+# so answering a request is two array lookups.
+SLOT_MINUTES = 30
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+BUCKETS = 7 * SLOTS_PER_DAY
+# Weight of a new observation, each bucket gets about 6 of them a week
+ALPHA = 0.1
+SINGAPORE_OFFSET = 8 * 60 * 60
+EMPTY_ROW = array('f', [float('nan')]) * BUCKETS
+
+# Index of the weekday and half hour (in Singapore time) that a unix time falls in
+def time_bucket(timestamp):
+    local = int(timestamp) + SINGAPORE_OFFSET
+    # 1 January 1970 was a Thursday, weekday 3 with Monday as 0
+    weekday = (local // 86400 + 3) % 7
+    return weekday * SLOTS_PER_DAY + (local % 86400) // (SLOT_MINUTES * 60)
+
+# Reads take no lock. Updates to a forecaster that is already shared hold self.lock, so
+# two refreshes (e.g. the refresh_snapshot job and the ingestion pipeline) can't both
+# observe the same sample or hand out the same new position.
+class Forecaster:
+    def __init__(self):
+        self.positions = {}  # car_park_no -> row of the carpark in every table
+        self.tables = {}     # lot_type -> array('f') of len(positions) * BUCKETS
+        self.last_observed = None
+        self.lock = Lock()
+        # (features, now) observed while rebuild_forecaster builds the tables replacing these
+        self.replay = None
+
+    # Tables are always grown before a position is handed out, so a request reading
+    # concurrently with a refresh never indexes past the end of a table
+    def position(self, car_park_no):
+        position = self.positions.get(car_park_no)
+        if position is None:
+            for table in self.tables.values():
+                table.extend(EMPTY_ROW)
+            position = self.positions[car_park_no] = len(self.positions)
+        return position
+
+    def table(self, lot_type):
+        table = self.tables.get(lot_type)
+        if table is None:
+            table = self.tables[lot_type] = EMPTY_ROW * len(self.positions)
+        return table
+
+    # Observes every lot type of the snapshot features, unless a sample as recent was already observed
+    def observe_features(self, features, now):
+        from .history import RAW
+
+        if self.last_observed is not None and now // RAW <= self.last_observed:
+            return
+        self.last_observed = now // RAW
+        bucket = time_bucket(now)
+        for feature in features:
+            for lot_type, (total_lots, lots_available) in feature.get('lots', {}).items():
+                self.observe(feature['car_park_no'], lot_type, lots_available, bucket)
+
+    def observe(self, car_park_no, lot_type, lots_available, bucket):
+        table = self.table(lot_type)
+        i = self.position(car_park_no) * BUCKETS + bucket
+        typical = table[i]
+        table[i] = lots_available if isnan(typical) else typical + ALPHA * (lots_available - typical)
+
+    # Returns the typical lots available for the carpark in the bucket, or None if unknown
+    def typical_lots_available(self, car_park_no, bucket, lot_type='C'):
+        position = self.positions.get(car_park_no)
+        table = self.tables.get(lot_type)
+        if position is None or table is None:
+            return None
+        typical = table[position * BUCKETS + bucket]
+        return None if isnan(typical) else typical
+
+    # Mean of the typical lots available at the same time of day on every weekday
+    # there is data for, used until a weekday has been seen at that time
+    def typical_lots_available_any_day(self, car_park_no, bucket, lot_type='C'):
+        position = self.positions.get(car_park_no)
+        table = self.tables.get(lot_type)
+        if position is None or table is None:
+            return None
+        start = position * BUCKETS + bucket % SLOTS_PER_DAY
+        values = [table[i] for i in range(start, start + BUCKETS, SLOTS_PER_DAY) if not isnan(table[i])]
+        return sum(values) / len(values) if values else None
+
+    # Expected lots available at `arrival` (unix time) given `lots_available` now
+    # The current value is moved by how much availability usually changes between the
+    # two times of the week, so a carpark that is emptier than usual stays emptier
+    def expected_lots_available(self, car_park_no, lots_available, arrival, lot_type='C', total_lots=None, now=None):
+        now = now if now is not None else time()
+        typical_now = self.typical_lots_available(car_park_no, time_bucket(now), lot_type)
+        typical_then = self.typical_lots_available(car_park_no, time_bucket(arrival), lot_type)
+        if typical_now is None or typical_then is None:
+            typical_now = self.typical_lots_available_any_day(car_park_no, time_bucket(now), lot_type)
+            typical_then = self.typical_lots_available_any_day(car_park_no, time_bucket(arrival), lot_type)
+        if typical_now is None or typical_then is None:
+            return lots_available
+        expected = lots_available + typical_then - typical_now
+        if total_lots is not None:
+            expected = min(expected, total_lots)
+        return max(0, round(expected))
+
+_forecaster = Forecaster()
+
+def get_forecaster():
+    return _forecaster
+
+# Builds new tables from the availability history: hourly rollups for the time before
+# the oldest raw sample, then the raw 5 minute samples, oldest first
+def build_forecaster():
+    from . import db
+    from .models import AvailabilityHistory, HistorySlot
+    from .history import RAW, HOURLY, MISSING, unpack
+
+    forecaster = Forecaster()
+    car_park_nos = {row.slot: row.car_park_no
+                    for row in db.session.execute(db.select(HistorySlot.car_park_no, HistorySlot.slot))}
+    oldest_raw = db.session.execute(
+        db.select(db.func.min(AvailabilityHistory.bucket_start)).where(AvailabilityHistory.resolution == RAW)
+    ).scalar()
+
+    query = (
+        db.select(AvailabilityHistory.resolution, AvailabilityHistory.lot_type,
+                  AvailabilityHistory.bucket_start, AvailabilityHistory.lots_available)
+        .where(db.or_(
+            AvailabilityHistory.resolution == RAW,
+            db.and_(AvailabilityHistory.resolution == HOURLY,
+                    AvailabilityHistory.bucket_start < (oldest_raw if oldest_raw is not None else 2**62))))
+        .order_by(AvailabilityHistory.bucket_start)
+    )
+    last_bucket_start = None
+    for resolution, lot_type, bucket_start, packed in db.session.execute(query):
+        # an hour covers two half hour buckets
+        buckets = [time_bucket(start) for start in range(bucket_start, bucket_start + resolution, SLOT_MINUTES * 60)]
+        for slot, lots_available in enumerate(unpack(packed)):
+            if lots_available == MISSING or slot not in car_park_nos:
+                continue
+            for bucket in buckets:
+                forecaster.observe(car_park_nos[slot], lot_type, lots_available, bucket)
+        last_bucket_start = bucket_start
+    if last_bucket_start is not None:
+        forecaster.last_observed = last_bucket_start // RAW
+    return forecaster
+
+# Run in the background, not on a request: rebuilds the tables and swaps them in
+# The refreshes keep observing the old tables while the new ones are built, and whatever
+# they observe is replayed into the new tables just before the swap (unless the history
+# read by build_forecaster already had it), under the old tables' lock so that nothing
+# is observed in between
+def rebuild_forecaster():
+    global _forecaster
+    old = _forecaster
+    with old.lock:
+        old.replay = []
+    try:
+        forecaster = build_forecaster()
+    except Exception:
+        with old.lock:
+            old.replay = None
+        raise
+    with old.lock:
+        for features, now in old.replay:
+            forecaster.observe_features(features, now)
+        old.replay = None
+        _forecaster = forecaster
+    logger.info(f"Forecast tables rebuilt for {len(forecaster.positions)} carparks")
+    return forecaster
+
+# Adds the availability of the snapshot features (see generate_geojson) to the tables
+# Called after every refresh, at most once per 5 minute sample
+def observe_availability(features, now=None):
+    now = int(now if now is not None else time())
+    while True:
+        forecaster = _forecaster
+        with forecaster.lock:
+            # Swapped by rebuild_forecaster while waiting for the lock, observe the new tables
+            if forecaster is not _forecaster:
+                continue
+            if forecaster.replay is not None:
+                forecaster.replay.append((features, now))
+            forecaster.observe_features(features, now)
+            return
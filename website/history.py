@@ -0,0 +1,219 @@
+import sys
+from array import array
+from datetime import datetime, timezone
+from itertools import groupby
+from time import time
+
+# Availability history, kept at three resolutions (bucket length in seconds)
+# Every refresh stores one raw sample per lot type: the lots_available of every carpark
+# packed into one array, so a day of samples is 288 rows instead of 288 * 2200.
+# Completed hours are rolled up into hourly buckets and completed days into daily ones,
+# and each resolution is only kept for as long as RETENTION says.
+RAW = 5 * 60
+HOURLY = 60 * 60
+DAILY = 24 * 60 * 60
+RESOLUTIONS = {'5min': RAW, 'hour': HOURLY, 'day': DAILY}
+RETENTION = {
+    RAW: 2 * DAILY,
+    HOURLY: 35 * DAILY,
+    DAILY: 400 * DAILY,
+}
+ROLLUPS = ((RAW, HOURLY), (HOURLY, DAILY))
+MISSING = -1
+# Buckets start on Singapore time (UTC+8) boundaries, so a daily bucket is a day in Singapore
+# like the ones drivers see. Raw and hourly buckets are the same as in UTC.
+SINGAPORE_OFFSET = 8 * 60 * 60
+
+# Returns the start of the bucket of the given resolution that unix time t is in
+def bucket_of(t, resolution):
+    return t - (t + SINGAPORE_OFFSET) % resolution
+
+def pack(values):
+    packed = array('h', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+def unpack(data):
+    values = array('h')
+    values.frombytes(data or b'')
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+# Returns car_park_no -> slot, assigning slots to the carparks that don't have one yet
+def get_slots(car_park_nos):
+    from . import db
+    from .models import HistorySlot
+
+    slots = {row.car_park_no: row.slot for row in db.session.execute(db.select(HistorySlot.car_park_no, HistorySlot.slot))}
+    new = sorted(set(car_park_nos) - slots.keys())
+    if new:
+        next_slot = max(slots.values(), default=-1) + 1
+        rows = [{'car_park_no': car_park_no, 'slot': next_slot + i} for i, car_park_no in enumerate(new)]
+        db.session.execute(db.insert(HistorySlot), rows)
+        slots.update((row['car_park_no'], row['slot']) for row in rows)
+    return slots
+
+def save_bucket(resolution, lot_type, bucket_start, samples, lots_available, min_lots=None, max_lots=None):
+    from . import db
+    from .models import AvailabilityHistory
+
+    # A second refresh in the same bucket replaces the first one
+    db.session.execute(db.delete(AvailabilityHistory).where(
+        AvailabilityHistory.resolution == resolution,
+        AvailabilityHistory.lot_type == lot_type,
+        AvailabilityHistory.bucket_start == bucket_start))
+    db.session.execute(db.insert(AvailabilityHistory), [{
+        'resolution': resolution,
+        'lot_type': lot_type,
+        'bucket_start': bucket_start,
+        'samples': samples,
+        'lots_available': pack(lots_available),
+        'min_lots_available': pack(min_lots) if min_lots is not None else None,
+        'max_lots_available': pack(max_lots) if max_lots is not None else None,
+    }])
+
+# Stores one raw sample from the availability of a refresh, then rolls up and expires
+# old buckets. lots maps (car_park_no, lot_type) to a tuple starting with
+# (total_lots, lots_available), as built by update_carparks_availability.
+def record_availability_sample(lots, now=None):
+    from . import db
+
+    now = int(now if now is not None else time())
+    slots = get_slots({car_park_no for car_park_no, _ in lots})
+    size = max(slots.values(), default=-1) + 1
+
+    by_lot_type = {}
+    for (car_park_no, lot_type), values in lots.items():
+        sample = by_lot_type.get(lot_type)
+        if sample is None:
+            sample = by_lot_type[lot_type] = [MISSING] * size
+        sample[slots[car_park_no]] = max(0, min(values[1], 32767))
+
+    bucket_start = bucket_of(now, RAW)
+    for lot_type, sample in by_lot_type.items():
+        save_bucket(RAW, lot_type, bucket_start, 1, sample)
+
+    roll_up(now)
+    expire(now)
+    db.session.commit()
+
+# Aggregates every completed bucket of the target resolution that isn't rolled up yet
+def roll_up(now):
+    from . import db
+    from .models import AvailabilityHistory
+
+    for source, target in ROLLUPS:
+        lot_types = db.session.execute(
+            db.select(AvailabilityHistory.lot_type).where(AvailabilityHistory.resolution == source).distinct()
+        ).scalars().all()
+        for lot_type in lot_types:
+            last = db.session.execute(
+                db.select(db.func.max(AvailabilityHistory.bucket_start))
+                .where(AvailabilityHistory.resolution == target, AvailabilityHistory.lot_type == lot_type)
+            ).scalar()
+            # bucket_of also realigns buckets rolled up before they were in Singapore time
+            start = bucket_of(last, target) + target if last is not None else 0
+            end = bucket_of(now, target)  # start of the bucket still in progress
+            if start >= end:
+                continue
+
+            rows = db.session.execute(
+                db.select(AvailabilityHistory)
+                .where(AvailabilityHistory.resolution == source, AvailabilityHistory.lot_type == lot_type,
+                       AvailabilityHistory.bucket_start >= start, AvailabilityHistory.bucket_start < end)
+                .order_by(AvailabilityHistory.bucket_start)
+            ).scalars().all()
+            for bucket_start, bucket_rows in groupby(rows, key=lambda row: bucket_of(row.bucket_start, target)):
+                save_bucket(target, lot_type, bucket_start, *aggregate(list(bucket_rows)))
+
+# Mean, minimum and maximum of each slot over the rows, ignoring missing values
+# The mean is weighted by the samples in each row, so a bucket with fewer refreshes
+# (e.g. an hour with failed fetches) doesn't count as much as a full one
+def aggregate(rows):
+    averages = [unpack(row.lots_available) for row in rows]
+    minimums = [unpack(row.min_lots_available) if row.min_lots_available else values
+                for row, values in zip(rows, averages)]
+    maximums = [unpack(row.max_lots_available) if row.max_lots_available else values
+                for row, values in zip(rows, averages)]
+    size = max(len(values) for values in averages)
+
+    mean = [MISSING] * size
+    low = [MISSING] * size
+    high = [MISSING] * size
+    for slot in range(size):
+        present = [i for i, values in enumerate(averages) if slot < len(values) and values[slot] != MISSING]
+        if not present:
+            continue
+        mean[slot] = round(sum(averages[i][slot] * rows[i].samples for i in present) /
+                           sum(rows[i].samples for i in present))
+        low[slot] = min(minimums[i][slot] for i in present)
+        high[slot] = max(maximums[i][slot] for i in present)
+    return sum(row.samples for row in rows), mean, low, high
+
+def expire(now):
+    from . import db
+    from .models import AvailabilityHistory
+
+    for resolution, retention in RETENTION.items():
+        db.session.execute(db.delete(AvailabilityHistory).where(
+            AvailabilityHistory.resolution == resolution,
+            AvailabilityHistory.bucket_start < now - retention))
+
+# Picks the finest resolution that is still kept for the whole range
+def resolution_for(start, now):
+    for resolution in (RAW, HOURLY, DAILY):
+        if start >= now - RETENTION[resolution]:
+            return resolution
+    return DAILY
+
+# Returns the availability of one carpark between start and end (unix times) as a list of
+# {'time', 'lots_available', 'min_lots_available', 'max_lots_available'}
+# Only the 2 bytes of this carpark are read from each packed row.
+def get_availability_history(car_park_no, lot_type='C', start=None, end=None, resolution=None, now=None):
+    from . import db
+    from .models import AvailabilityHistory, HistorySlot
+
+    now = int(now if now is not None else time())
+    end = int(end if end is not None else now)
+    start = int(start if start is not None else end - DAILY)
+    if resolution is None:
+        resolution = resolution_for(start, now)
+
+    slot = db.session.execute(db.select(HistorySlot.slot).where(HistorySlot.car_park_no == car_park_no)).scalar()
+    if slot is None:
+        return []
+
+    offset = slot * 2 + 1
+    rows = db.session.execute(
+        db.select(AvailabilityHistory.bucket_start,
+                  db.func.substr(AvailabilityHistory.lots_available, offset, 2),
+                  db.func.substr(AvailabilityHistory.min_lots_available, offset, 2),
+                  db.func.substr(AvailabilityHistory.max_lots_available, offset, 2))
+        .where(AvailabilityHistory.resolution == resolution, AvailabilityHistory.lot_type == lot_type,
+               AvailabilityHistory.bucket_start >= bucket_of(start, resolution),
+               AvailabilityHistory.bucket_start <= end)
+        .order_by(AvailabilityHistory.bucket_start)
+    ).all()
+
+    points = []
+    for bucket_start, average, minimum, maximum in rows:
+        lots_available = decode(average)
+        if lots_available is None:
+            continue
+        minimum = decode(minimum)
+        maximum = decode(maximum)
+        points.append({
+            'time': datetime.fromtimestamp(bucket_start, timezone.utc).isoformat(),
+            'lots_available': lots_available,
+            'min_lots_available': minimum if minimum is not None else lots_available,
+            'max_lots_available': maximum if maximum is not None else lots_available,
+        })
+    return points
+
+def decode(data):
+    if not data or len(data) < 2:
+        return None
+    value = int.from_bytes(bytes(data), 'little', signed=True)
+    return None if value == MISSING else value
@@ -0,0 +1,94 @@
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from time import monotonic
+from flask_login import UserMixin
+
+# Read-only copies of the rows the views need about the logged in user
+# Anything that changes them must call invalidate_identity(user_id)
+DriverInfo = namedtuple('DriverInfo', ['id', 'first_name', 'points', 'interested_carpark'])
+CompanyInfo = namedtuple('CompanyInfo', ['id', 'company_name'])
+
+# What flask-login keeps as current_user
+class Identity(UserMixin):
+    def __init__(self, id, user_type, driver=None, company=None, has_vehicle=False):
+        self.id = id
+        self.user_type = user_type
+        self.driver = driver
+        self.company = company
+        self.has_vehicle = has_vehicle
+
+# A small LRU cache whose entries also expire after ttl seconds, so that changes
+# made by other processes (or missed invalidations) are picked up eventually
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'invalidations': self.invalidations, 'size': len(self.entries)}
+
+_identities = TTLCache(maxsize=10000, ttl=60)
+
+# Loads the user, their driver or company row and whether they have a vehicle in one query
+def query_identity(user_id):
+    from . import db
+    from .models import User, Driver, Company, Vehicle
+
+    has_vehicle = db.exists().where(Vehicle.user_id == User.id)
+    row = db.session.execute(
+        db.select(User.id, User.user_type,
+                  Driver.id, Driver.first_name, Driver.points, Driver.interested_carpark,
+                  Company.id, Company.company_name, has_vehicle.label('has_vehicle'))
+        .outerjoin(Driver, Driver.user_id == User.id)
+        .outerjoin(Company, Company.user_id == User.id)
+        .where(User.id == user_id)
+    ).first()
+    if row is None:
+        return None
+
+    driver = DriverInfo(*row[2:6]) if row[2] is not None else None
+    company = CompanyInfo(*row[6:8]) if row[6] is not None else None
+    return Identity(row[0], row[1], driver, company, bool(row.has_vehicle))
+
+def load_identity(user_id):
+    identity = _identities.get(user_id)
+    if identity is None:
+        identity = query_identity(user_id)
+        if identity is not None:
+            _identities.set(user_id, identity)
+    return identity
+
+def invalidate_identity(user_id):
+    _identities.invalidate(user_id)
+
+def identity_cache_stats():
+    return _identities.stats()
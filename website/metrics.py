@@ -0,0 +1,246 @@
+import os
+from threading import Lock
+from time import perf_counter, time
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Number of the slowest statements of a request kept for the slow request log
+SLOWEST_STATEMENTS = 3
+
+def default_metrics_config():
+    slow_request_seconds = os.getenv('SLOW_REQUEST_SECONDS')
+    return {
+        # Requests taking longer than this are logged with their slowest queries, None to disable
+        'SLOW_REQUEST_SECONDS': float(slow_request_seconds) if slow_request_seconds else None,
+        # If set, /metrics needs an "Authorization: Bearer <token>" header
+        'METRICS_TOKEN': os.getenv('METRICS_TOKEN'),
+    }
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+# Collects what is measured in this process, kept in app.extensions['metrics']
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.latency = {}           # (endpoint, method) -> Histogram
+        self.responses = {}         # (endpoint, method, status) -> count
+        self.request_sql = {}       # endpoint -> [statements, seconds]
+        self.sql = {'request': [0, 0.0], 'background': [0, 0.0]}
+
+    def record_request(self, endpoint, method, status, seconds, statements, sql_seconds):
+        with self.lock:
+            histogram = self.latency.get((endpoint, method))
+            if histogram is None:
+                histogram = self.latency[(endpoint, method)] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+            key = (endpoint, method, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+            sql = self.request_sql.setdefault(endpoint, [0, 0.0])
+            sql[0] += statements
+            sql[1] += sql_seconds
+
+    def record_statement(self, context, seconds):
+        with self.lock:
+            sql = self.sql[context]
+            sql[0] += 1
+            sql[1] += seconds
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+# after_cursor_execute isn't called for a statement that fails
+def on_error(context):
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+def make_after_cursor_execute(metrics):
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = perf_counter() - conn.info['query_start'].pop()
+        if has_request_context() and 'metrics_start' in g:
+            metrics.record_statement('request', seconds)
+            g.sql_statements += 1
+            g.sql_seconds += seconds
+            slowest = g.sql_slowest
+            if len(slowest) < SLOWEST_STATEMENTS or seconds > slowest[-1][0]:
+                slowest.append((seconds, statement))
+                slowest.sort(key=lambda s: s[0], reverse=True)
+                del slowest[SLOWEST_STATEMENTS:]
+        else:
+            metrics.record_statement('background', seconds)
+    return after_cursor_execute
+
+def start_request():
+    g.metrics_start = perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+    g.sql_slowest = []
+
+def finish_request(response):
+    if 'metrics_start' not in g:
+        return response
+    seconds = perf_counter() - g.metrics_start
+    # The rule, not the path, so that e.g. /carparks/<car_park_no> is one series
+    endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+    current_app.extensions['metrics'].record_request(
+        endpoint, request.method, response.status_code, seconds, g.sql_statements, g.sql_seconds)
+
+    slow_request_seconds = current_app.config.get('SLOW_REQUEST_SECONDS')
+    if slow_request_seconds is not None and seconds >= slow_request_seconds:
+        queries = ''.join(f"\n  {s * 1000:.1f} ms: {' '.join(statement.split())[:300]}"
+                          for s, statement in g.sql_slowest)
+        current_app.logger.warning(
+            f"Slow request: {request.method} {request.full_path.rstrip('?')} ({endpoint}) took {seconds * 1000:.1f} ms, "
+            f"{g.sql_statements} SQL statements in {g.sql_seconds * 1000:.1f} ms{queries}")
+    return response
+
+# Hooks the request timing and SQL counting into the app, must be called with an app context
+def init_metrics(app, engine):
+    metrics = Metrics()
+    app.extensions['metrics'] = metrics
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", make_after_cursor_execute(metrics))
+    event.listen(engine, "handle_error", on_error)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.add_url_rule('/metrics', 'metrics', get_metrics)
+    return metrics
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels.items()) + '}'
+
+# Writes metrics in the Prometheus text exposition format
+class MetricsWriter:
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, help, samples):
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            self.lines.append(f"{name}{format_labels(labels)} {value}")
+
+    def histogram(self, name, help, histograms):
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                self.lines.append(f"{name}_bucket{format_labels({**labels, 'le': bound})} {cumulative}")
+            self.lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {histogram.count}")
+            self.lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            self.lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+def render_metrics(app):
+    from .snapshot import get_snapshot
+    from .identity import identity_cache_stats
+    from .events import broker
+
+    metrics = app.extensions['metrics']
+    out = MetricsWriter()
+
+    with metrics.lock:
+        latency = [({'endpoint': endpoint, 'method': method}, histogram)
+                   for (endpoint, method), histogram in sorted(metrics.latency.items())]
+        out.histogram('http_request_duration_seconds', "Time to handle a request, by route", latency)
+        out.metric('http_responses_total', 'counter', "Responses sent, by route and status",
+                   [({'endpoint': endpoint, 'method': method, 'status': status}, count)
+                    for (endpoint, method, status), count in sorted(metrics.responses.items())])
+        out.metric('http_request_sql_statements_total', 'counter', "SQL statements sent while handling requests, by route",
+                   [({'endpoint': endpoint}, sql[0]) for endpoint, sql in sorted(metrics.request_sql.items())])
+        out.metric('http_request_sql_seconds_total', 'counter', "Time spent in SQL statements while handling requests, by route",
+                   [({'endpoint': endpoint}, sql[1]) for endpoint, sql in sorted(metrics.request_sql.items())])
+        out.metric('sql_statements_total', 'counter', "SQL statements sent, by requests or background jobs",
+                   [({'context': context}, sql[0]) for context, sql in metrics.sql.items()])
+        out.metric('sql_seconds_total', 'counter', "Time spent in SQL statements, by requests or background jobs",
+                   [({'context': context}, sql[1]) for context, sql in metrics.sql.items()])
+
+    scheduler = app.extensions.get('scheduler')
+    if scheduler is not None:
+        jobs = sorted(scheduler.stats().items())
+        out.metric('job_runs_total', 'counter', "Runs of each background job",
+                   [({'job': name}, stats['runs']) for name, stats in jobs])
+        out.metric('job_failures_total', 'counter', "Runs of each background job that raised an exception",
+                   [({'job': name}, stats['failures']) for name, stats in jobs])
+        out.metric('job_skipped_total', 'counter', "Runs skipped because another process is the leader",
+                   [({'job': name}, stats['skipped']) for name, stats in jobs])
+        out.metric('job_duration_seconds_total', 'counter', "Time spent running each background job",
+                   [({'job': name}, stats['total_duration']) for name, stats in jobs])
+        out.metric('job_last_duration_seconds', 'gauge', "Duration of the last run of each background job",
+                   [({'job': name}, stats['last_duration']) for name, stats in jobs if stats['last_duration'] is not None])
+        out.metric('job_last_run_timestamp_seconds', 'gauge', "Unix time the last run of each background job started",
+                   [({'job': name}, stats['last_run_at']) for name, stats in jobs if stats['last_run_at'] is not None])
+        out.metric('job_last_run_success', 'gauge', "1 if the last run of each background job succeeded",
+                   [({'job': name}, int(stats['last_error'] is None)) for name, stats in jobs if stats['runs']])
+
+    pipeline = app.extensions.get('pipeline')
+    if pipeline is not None:
+        feeds = sorted(pipeline.stats().items())
+        out.metric('ingest_runs_total', 'counter', "Feeds that went through the ingestion pipeline",
+                   [({'feed': feed}, stats['runs']) for feed, stats in feeds])
+        out.metric('ingest_not_modified_total', 'counter', "Feed fetches that were not modified since the last run",
+                   [({'feed': feed}, stats['not_modified']) for feed, stats in feeds])
+        out.metric('ingest_stage_seconds_total', 'counter', "Time spent in each stage of the ingestion pipeline",
+                   [({'feed': feed, 'stage': stage}, seconds)
+                    for feed, stats in feeds for stage, seconds in stats['total'].items()])
+        out.metric('ingest_last_stage_seconds', 'gauge', "Duration of each stage in the last run of the pipeline",
+                   [({'feed': feed, 'stage': stage}, seconds)
+                    for feed, stats in feeds for stage, seconds in stats['last'].items()])
+        out.metric('ingest_freshness_lag_seconds', 'gauge',
+                   "Seconds between the newest update in the feed and the end of its last run",
+                   [({'feed': feed}, stats['lag']) for feed, stats in feeds if stats['lag'] is not None])
+
+    snapshot = get_snapshot()
+    out.metric('carparks_snapshot_version', 'gauge', "Version of the carpark snapshot being served", [({}, snapshot.version)])
+    out.metric('carparks_snapshot_carparks', 'gauge', "Carparks in the snapshot", [({}, len(snapshot.by_number))])
+    out.metric('carparks_snapshot_bytes', 'gauge', "Size of the snapshot body, by encoding",
+               [({'encoding': 'identity'}, len(snapshot.body))] +
+               [({'encoding': encoding}, size) for encoding, size in sorted(snapshot.encoded_sizes().items())])
+    out.metric('carparks_snapshot_age_seconds', 'gauge', "Seconds since the snapshot was published",
+               [({}, round(time() - snapshot.created_at, 3))])
+
+    identities = identity_cache_stats()
+    out.metric('identity_cache_hits_total', 'counter', "Logged in users found in the identity cache", [({}, identities['hits'])])
+    out.metric('identity_cache_misses_total', 'counter', "Logged in users loaded from the database", [({}, identities['misses'])])
+    out.metric('identity_cache_invalidations_total', 'counter', "Identity cache entries dropped after a change",
+               [({}, identities['invalidations'])])
+    out.metric('identity_cache_entries', 'gauge', "Entries in the identity cache", [({}, identities['size'])])
+
+    out.metric('event_streams', 'gauge', "Open /carparks/stream connections", [({}, broker.subscribers)])
+    out.metric('event_streams_rejected_total', 'counter', "Streams refused because MAX_EVENT_STREAMS were open",
+               [({}, broker.rejected)])
+
+    upstream = app.extensions.get('upstream')
+    if upstream is not None:
+        out.metric('upstream_requests_total', 'counter', "Requests to data.gov.sg, by result",
+                   [({'result': result}, count) for result, count in sorted(upstream.get_stats().items())])
+    return out.text()
+
+def get_metrics():
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    return Response(render_metrics(current_app), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,72 @@
+import logging
+from datetime import datetime
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+# db.create_all() only creates missing tables, it never changes tables that already exist.
+# Each migration below brings an existing database.db up to date with models.py and
+# runs once per database. The versions that were applied are kept in schema_migrations.
+# Migrations also run on new databases (after create_all), so they must check before
+# changing anything.
+
+def add_column_if_missing(conn, table, column, column_type):
+    columns = [c['name'] for c in inspect(conn).get_columns(table)]
+    if column not in columns:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}'))
+
+def create_indexes(conn, table, names):
+    from . import db
+    indexes = {index.name: index for index in db.metadata.tables[table].indexes}
+    for name in names:
+        indexes[name].create(bind=conn, checkfirst=True)
+
+def add_carpark_sync_columns(conn):
+    add_column_if_missing(conn, 'carpark', 'record_hash', 'VARCHAR(40)')
+    add_column_if_missing(conn, 'carpark', 'is_deleted', 'BOOLEAN DEFAULT 0')
+
+def add_lookup_indexes(conn):
+    create_indexes(conn, 'driver', ['ix_driver_user_id', 'ix_driver_interested_carpark'])
+    create_indexes(conn, 'company', ['ix_company_user_id'])
+    create_indexes(conn, 'vehicle', ['ix_vehicle_user_id', 'ix_vehicle_car_plate'])
+    create_indexes(conn, 'reward', ['ix_reward_user_id', 'ix_reward_reward_category_id'])
+    create_indexes(conn, 'user_claimed_rewards', ['ix_user_claimed_rewards_driver_user_id_reward_id',
+                                                  'ix_user_claimed_rewards_reward_id'])
+    create_indexes(conn, 'carpark', ['ix_carpark_address'])
+
+def add_carpark_generation_row(conn):
+    conn.execute(text('INSERT OR IGNORE INTO carpark_generation (id, generation) VALUES (1, 0)'))
+
+# (version, description, function) in the order they have to be applied
+MIGRATIONS = [
+    (1, "Add record_hash and is_deleted to carpark", add_carpark_sync_columns),
+    (2, "Add indexes for the hot lookup columns", add_lookup_indexes),
+    (3, "Add the carpark generation row", add_carpark_generation_row),
+]
+
+def get_applied_versions(conn):
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations '
+        '(version INTEGER PRIMARY KEY, description VARCHAR(150), applied_at VARCHAR(30))'))
+    return {row[0] for row in conn.execute(text('SELECT version FROM schema_migrations'))}
+
+# Applies every migration that hasn't been applied yet, each in its own transaction
+# Returns the versions that were applied
+def run_migrations(engine):
+    applied = []
+    with engine.begin() as conn:
+        done = get_applied_versions(conn)
+
+    for version, description, migrate in MIGRATIONS:
+        if version in done:
+            continue
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(
+                text('INSERT INTO schema_migrations (version, description, applied_at) '
+                     'VALUES (:version, :description, :applied_at)'),
+                {'version': version, 'description': description,
+                 'applied_at': datetime.utcnow().isoformat(timespec='seconds')})
+        logger.info(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
@@ -19,24 +19,26 @@ class Driver(db.Model):
     password = db.Column(db.String(150))
     first_name = db.Column(db.String(150))
     points = db.Column(db.Integer)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    interested_carpark = db.Column(db.String, db.ForeignKey('carpark.car_park_no'))
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), unique=True, index=True)
+    interested_carpark = db.Column(db.String, db.ForeignKey('carpark.car_park_no'), index=True)
 
 class Company(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     company_name = db.Column(db.String(150))
     uen = db.Column(db.String(150), unique=True)
     password = db.Column(db.String(150))
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), unique=True, index=True)
 
 class Vehicle(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     full_name = db.Column(db.String(150))
-    car_plate = db.Column(db.String(150))
+    car_plate = db.Column(db.String(150), index=True)
     coe_expiry = db.Column(db.Date)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
 
 class Reward(db.Model):
+    # rewards are listed page by page in id order, optionally for one category
+    __table_args__ = (db.Index('ix_reward_reward_category_id', 'reward_category', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     reward_title = db.Column(db.String(150))
     reward_expiry = db.Column(db.Date)
@@ -44,14 +46,14 @@ class Reward(db.Model):
     reward_details = db.Column(db.String(10000))
     number_of_rewards = db.Column(db.Integer)
     cost_of_reward = db.Column(db.Float)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id')) # this user_id is the company that created the reward (NOT CLAIMANTS)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True) # this user_id is the company that created the reward (NOT CLAIMANTS)
     company = db.relationship('User', backref='company')
     user_claimed_rewards = db.relationship('UserClaimedRewards')
 
 class CarPark(db.Model):
     __tablename__ = 'carpark'
     car_park_no = db.Column(db.String, primary_key=True)
-    address = db.Column(db.String(150))
+    address = db.Column(db.String(150), index=True)
     x_coord = db.Column(db.Float)
     y_coord = db.Column(db.Float)
     latitude = db.Column(db.Float)
@@ -71,8 +73,55 @@ class CarPark(db.Model):
     # jona's additions 
     interested_drivers = db.relationship('Driver', backref='interested_carpark_obj')
     no_of_interested_drivers = db.Column(db.Integer)
+    # fingerprint of the data.gov.sg record this row was last synced from
+    record_hash = db.Column(db.String(40))
+    # carparks removed from the dataset are kept (drivers may still refer to them) but hidden
+    is_deleted = db.Column(db.Boolean, default=False)
+
+# A single row counting the writes to the carparks (master data, availability and interested
+# drivers). It is bumped in the same transaction as each of them, so a process can tell from
+# one lookup whether its snapshot is behind the database, see refresh_snapshot_if_stale()
+class CarParkGeneration(db.Model):
+    __tablename__ = 'carpark_generation'
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
+# Availability of each lot type of a carpark (C for cars, Y for motorcycles, H for heavy vehicles)
+# CarPark.total_lots/lots_available/lot_type above hold the first lot type in the feed, usually C
+class CarParkAvailability(db.Model):
+    __tablename__ = 'carpark_availability'
+    # on SQLite the rows are stored in the primary key index itself, without a separate rowid table
+    __table_args__ = {'sqlite_with_rowid': False}
+    car_park_no = db.Column(db.String, db.ForeignKey('carpark.car_park_no'), primary_key=True)
+    lot_type = db.Column(db.String(1), primary_key=True)
+    total_lots = db.Column(db.Integer)
+    lots_available = db.Column(db.Integer)
+    last_updated = db.Column(db.String(150))
+
+# Position of a carpark in the packed arrays of AvailabilityHistory, assigned once and never reused
+class HistorySlot(db.Model):
+    __tablename__ = 'history_slot'
+    car_park_no = db.Column(db.String, primary_key=True)
+    slot = db.Column(db.Integer, unique=True, nullable=False)
+
+# Availability of every carpark for one lot type over one time bucket, see history.py
+# The lots_available columns are packed arrays of 16 bit integers, one per HistorySlot
+# (-1 where the carpark had no data). Raw 5 minute samples only fill lots_available,
+# hourly and daily rollups also keep the minimum and maximum.
+class AvailabilityHistory(db.Model):
+    __tablename__ = 'availability_history'
+    __table_args__ = {'sqlite_with_rowid': False}
+    resolution = db.Column(db.Integer, primary_key=True) # bucket length in seconds
+    lot_type = db.Column(db.String(1), primary_key=True)
+    bucket_start = db.Column(db.Integer, primary_key=True) # unix time
+    samples = db.Column(db.Integer)
+    lots_available = db.Column(db.LargeBinary)
+    min_lots_available = db.Column(db.LargeBinary)
+    max_lots_available = db.Column(db.LargeBinary)
 
 class UserClaimedRewards(db.Model):
+    # a driver can claim the same reward more than once, so this is not unique
+    __table_args__ = (db.Index('ix_user_claimed_rewards_driver_user_id_reward_id', 'driver_user_id', 'reward_id'),)
     id = db.Column(db.Integer, primary_key=True)
     driver_user_id = db.Column(db.Integer, db.ForeignKey('user.id')) # this user IS the claimant - not the company.
-    reward_id = db.Column(db.Integer, db.ForeignKey('reward.id'))
\ No newline at end of file
+    reward_id = db.Column(db.Integer, db.ForeignKey('reward.id'), index=True)
\ No newline at end of file
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from time import perf_counter, time
+
+# Ingestion of the data.gov.sg feeds as one staged pipeline driven by an asyncio event loop
+#   fetch    the requests for both feeds run concurrently, under a deadline per feed
+#   parse    the streamed body is parsed and transformed (coordinates converted) in a
+#            parse thread, and handed on in batches of WRITE_BATCH_SIZE records through a
+#            bounded queue, so only a few batches of a feed are ever in memory
+#   write    each feed's writer diffs the batches as they arrive, but writes and commits
+#            them one batch at a time under a single write lock. SQLite only ever sees one
+#            writer, and a feed waiting on a slow body holds no lock or transaction, so a
+#            slow carpark information fetch can't hold up availability updates.
+#   publish  the serving snapshot is rebuilt and swapped in its own thread, so the writer
+#            can move on to the next feed
+# The loop runs in a daemon thread. The scheduler jobs call run() and wait for the feed
+# to go through, so their timing, leader lock and backoff still apply.
+# Stage timings and the freshness lag (publish time - newest update_datetime in the feed)
+# are logged after every run and kept for /metrics, see stats(). Parsing and writing
+# overlap, so parse is the time to read the whole body and write the time the writer
+# still needed after that. The write and publish timings include any wait for the other
+# feed to leave the write lock or publisher.
+
+logger = logging.getLogger(__name__)
+
+# feed -> config key of its url
+FEEDS = {
+    'carparks': 'CARPARK_INFO_URL',
+    'availability': 'CARPARK_AVAILABILITY_URL',
+}
+STAGES = ('fetch', 'parse', 'write', 'publish')
+# Batches a parser can get ahead of its writer
+QUEUED_BATCHES = 2
+# Marks the end of a feed in a BatchQueue
+DONE = object()
+
+class FeedCancelled(Exception):
+    pass
+
+# Bounded queue of record batches from the parse thread to the writer of one feed
+# Either side gives up once the feed is cancelled, so neither is left blocked
+# when the other one failed or the deadline passed
+class BatchQueue:
+    def __init__(self, maxsize=QUEUED_BATCHES):
+        self.queue = Queue(maxsize)
+        self.cancelled = Event()
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise FeedCancelled()
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def cancel(self):
+        self.cancelled.set()
+
+    # Yields the records of every batch, raising the parser's error if it failed
+    def records(self):
+        while True:
+            if self.cancelled.is_set():
+                raise FeedCancelled()
+            try:
+                item = self.queue.get(timeout=0.1)
+            except Empty:
+                continue
+            if item is DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield from item
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+# Parsers put batches of records and return the newest update_datetime in the feed
+def parse_carparks(response, put):
+    from .update_carparks import iter_carpark_records, with_coordinates, WRITE_BATCH_SIZE
+    for batch in batched(iter_carpark_records(response.raw), WRITE_BATCH_SIZE):
+        put(with_coordinates(batch))
+    return None
+
+def parse_availability(response, put):
+    from .update_carparks import iter_availability_records, WRITE_BATCH_SIZE
+    newest = ''
+    for batch in batched(iter_availability_records(response.raw), WRITE_BATCH_SIZE):
+        newest = max(newest, max(r.get('update_datetime') or '' for r in batch))
+        put(batch)
+    return newest or None
+
+def write_carparks(records, write_lock):
+    from .update_carparks import update_carparks
+    return update_carparks(records, publish=False, write_lock=write_lock)
+
+def write_availability(records, write_lock):
+    from .update_carparks import update_carparks_availability
+    return update_carparks_availability(records, write_lock=write_lock)
+
+def publish_carparks(stats):
+    from .update_carparks import generate_geojson
+    if stats.get('incomplete'):
+        return None
+    if stats['inserted'] or stats['updated'] or stats['deleted']:
+        return generate_geojson()
+    return None
+
+def publish_availability(stats):
+    from .update_carparks import publish_availability_changes
+    return publish_availability_changes(stats)
+
+PARSERS = {'carparks': parse_carparks, 'availability': parse_availability}
+WRITERS = {'carparks': write_carparks, 'availability': write_availability}
+PUBLISHERS = {'carparks': publish_carparks, 'availability': publish_availability}
+
+# Closes the response of a fetch that finished after its deadline, which would otherwise
+# keep its pooled connection
+def close_late_response(future):
+    if not future.cancelled() and future.exception() is None and future.result() is not None:
+        future.result().close()
+
+# Retrieves the outcome of a stage that is no longer awaited, so its error isn't logged as unhandled
+def discard_outcome(future):
+    if not future.cancelled():
+        future.exception()
+
+class IngestionPipeline:
+    def __init__(self, app):
+        self.app = app
+        self.loop = None
+        self.thread = None
+        self.start_lock = Lock()
+        self.fetch_executor = ThreadPoolExecutor(len(FEEDS), thread_name_prefix='ingest-fetch')
+        self.parse_executor = ThreadPoolExecutor(len(FEEDS), thread_name_prefix='ingest-parse')
+        self.writers = ThreadPoolExecutor(len(FEEDS), thread_name_prefix='ingest-write')
+        # Held by a writer while it writes and commits a batch
+        self.write_lock = Lock()
+        self.publisher = ThreadPoolExecutor(1, thread_name_prefix='ingest-publish')
+        self.stats_lock = Lock()
+        self.feed_stats = {feed: {'runs': 0, 'not_modified': 0, 'last': {}, 'total': dict.fromkeys(STAGES, 0.0),
+                                  'lag': None} for feed in FEEDS}
+
+    def start(self):
+        with self.start_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = Thread(target=self.loop.run_forever, name='ingest-loop', daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        for executor in (self.fetch_executor, self.parse_executor, self.writers, self.publisher):
+            executor.shutdown(wait=False)
+
+    # Runs the given feeds (all of them by default) through the pipeline concurrently and
+    # waits for them. Returns feed -> stats of the write stage. Can be called from any thread.
+    def run(self, *feeds):
+        self.start()
+        feeds = feeds or tuple(FEEDS)
+        future = asyncio.run_coroutine_threadsafe(self.ingest_all(feeds), self.loop)
+        return future.result()
+
+    async def ingest_all(self, feeds):
+        results = await asyncio.gather(*(self.ingest(feed) for feed in feeds))
+        return dict(zip(feeds, results))
+
+    def in_executor(self, executor, fn, *args):
+        def call():
+            with self.app.app_context():
+                return fn(*args)
+        return asyncio.get_running_loop().run_in_executor(executor, call)
+
+    # Runs in a parse thread, the outcome is also passed on to the writer through the queue
+    @staticmethod
+    def parse(feed, response, batches):
+        try:
+            newest = PARSERS[feed](response, batches.put)
+        except FeedCancelled:
+            raise
+        except BaseException as e:
+            try:
+                batches.put(e)
+            except FeedCancelled:
+                pass
+            raise
+        batches.put(DONE)
+        return newest
+
+    async def ingest(self, feed):
+        loop = asyncio.get_running_loop()
+        upstream = self.app.extensions['upstream']
+        url = self.app.config[FEEDS[feed]]
+        deadline = self.app.config['UPSTREAM_FETCH_DEADLINE']
+        timings = {}
+
+        start = perf_counter()
+        fetch = loop.run_in_executor(self.fetch_executor, upstream.get, url)
+        try:
+            response = await asyncio.wait_for(asyncio.shield(fetch), deadline)
+        except asyncio.TimeoutError:
+            # The request carries on in its thread
+            fetch.add_done_callback(close_late_response)
+            raise
+        timings['fetch'] = perf_counter() - start
+        if response is None:
+            with self.stats_lock:
+                self.feed_stats[feed]['not_modified'] += 1
+            logger.info(f"Ingest {feed}: not modified since the last update")
+            return {'not_modified': True}
+
+        batches = BatchQueue()
+        try:
+            stage_start = perf_counter()
+            parse = loop.run_in_executor(self.parse_executor, self.parse, feed, response, batches)
+            write = self.in_executor(self.writers, WRITERS[feed], batches.records(), self.write_lock)
+            await asyncio.wait({parse, write}, timeout=max(deadline - timings['fetch'], 0),
+                               return_when=asyncio.FIRST_EXCEPTION)
+            if not parse.done() or (write.done() and write.exception() is not None):
+                # Deadline passed or the writer failed: stop reading and writing this feed
+                batches.cancel()
+                for stage in (parse, write):
+                    stage.add_done_callback(discard_outcome)
+                if not parse.done():
+                    raise asyncio.TimeoutError(f"{feed} wasn't fetched within {deadline}s")
+                await write
+            if parse.exception() is not None:
+                write.add_done_callback(discard_outcome)
+            newest = await parse
+            timings['parse'] = perf_counter() - stage_start
+
+            stage_start = perf_counter()
+            stats = await write
+            # An incomplete feed is fetched in full again next time
+            if not stats.get('incomplete'):
+                upstream.mark_processed(url, response)
+            timings['write'] = perf_counter() - stage_start
+        finally:
+            response.close()
+
+        stage_start = perf_counter()
+        await self.in_executor(self.publisher, PUBLISHERS[feed], stats)
+        timings['publish'] = perf_counter() - stage_start
+
+        lag = None
+        if newest:
+            from .update_carparks import parse_update_datetime
+            newest = parse_update_datetime(newest)
+            if newest is not None:
+                lag = round(time() - newest.timestamp(), 3)
+        self.record(feed, timings, lag)
+        logger.info(f"Ingest {feed}: " + ', '.join(f"{stage} {timings[stage]:.3f}s" for stage in STAGES) +
+                    (f", freshness lag {lag:.0f}s" if lag is not None else ''))
+        return stats
+
+    def record(self, feed, timings, lag):
+        with self.stats_lock:
+            feed_stats = self.feed_stats[feed]
+            feed_stats['runs'] += 1
+            feed_stats['last'] = {stage: round(seconds, 4) for stage, seconds in timings.items()}
+            for stage, seconds in timings.items():
+                feed_stats['total'][stage] += seconds
+            feed_stats['lag'] = lag
+
+    def stats(self):
+        with self.stats_lock:
+            return {feed: {**feed_stats, 'last': dict(feed_stats['last']), 'total': dict(feed_stats['total'])}
+                    for feed, feed_stats in self.feed_stats.items()}
@@ -0,0 +1,28 @@
+from functools import lru_cache
+import pyproj
+
+SVY21_PROJ4 = "+proj=tmerc +lat_0=1.366666666666667 +lon_0=103.83333333333333 +k_0=1.0 +x_0=28001.642 +y_0=38744.572 +ellps=WGS84 +units=m +no_defs"
+WGS84_PROJ4 = "+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs"
+
+# Building the transformer is far more expensive than using it,
+# so it is created once per process and reused
+@lru_cache(maxsize=None)
+def get_svy21_transformer():
+    svy21 = pyproj.CRS.from_proj4(SVY21_PROJ4)
+    wgs84 = pyproj.CRS.from_proj4(WGS84_PROJ4)
+    return pyproj.Transformer.from_crs(svy21, wgs84)
+
+# Converts sequences of eastings (x) and northings (y) in a single transform call
+# Returns a list of (latitude, longitude)
+def svy21_to_wgs84_batch(xs, ys):
+    xs = list(xs)
+    ys = list(ys)
+    if not xs:
+        return []
+    lons, lats = get_svy21_transformer().transform(xs, ys)
+    return list(zip(lats, lons))
+
+# (x, y) is also known as (easting, northing)
+def svy21_to_wgs84(x, y):
+    lon, lat = get_svy21_transformer().transform(x, y)
+    return lat, lon
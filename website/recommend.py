@@ -0,0 +1,130 @@
+import heapq
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+# Ranks the carparks around a driver by how good a choice each one is for them
+# Every candidate gets a score made of
+#   + how many lots are effectively free (lots available, or expected at arrival, minus
+#     the other drivers who said they are heading there), up to ENOUGH_LOTS
+#   - how far it is, relative to the search radius
+#   + a bonus if parking is free at the arrival time
+# Carparks the driver can't use are dropped first: a gantry lower than the vehicle, no
+# short term parking at that time or, at night, no night parking.
+LOTS_WEIGHT = 1.0
+DISTANCE_WEIGHT = 1.0
+FREE_PARKING_WEIGHT = 0.3
+# Effective free lots beyond this don't make a carpark any better
+ENOUGH_LOTS = 50
+# HDB night parking hours, in minutes after midnight
+NIGHT_START = 22 * 60 + 30
+NIGHT_END = 7 * 60
+SINGAPORE = timezone(timedelta(hours=8))
+# Highest score a carpark can get before its distance is taken off
+MAX_SCORE = LOTS_WEIGHT + FREE_PARKING_WEIGHT
+
+TIME_PATTERN = re.compile(r'(\d{1,2})(?:\.(\d{2}))?\s*(AM|PM)')
+
+def to_minutes(hour, minute, meridiem):
+    return (int(hour) % 12 + (12 if meridiem == 'PM' else 0)) * 60 + int(minute or 0)
+
+# Returns the (start, end) minutes after midnight in a text like "SUN & PH FR 7AM-10.30PM"
+# or "7AM-7PM", (0, 1440) for "WHOLE DAY" and None if it has no hours
+@lru_cache(maxsize=None)
+def parse_hours(text):
+    if not text or text == 'NO':
+        return None
+    if 'WHOLE DAY' in text:
+        return (0, 24 * 60)
+    times = TIME_PATTERN.findall(text)
+    if len(times) != 2:
+        return None
+    return to_minutes(*times[0]), to_minutes(*times[1])
+
+def within(hours, minute):
+    start, end = hours
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+def is_night(minute):
+    return within((NIGHT_START, NIGHT_END), minute)
+
+# Returns (allowed, free) for the parking rules of a carpark at the given time
+# Public holidays aren't known here, so free parking only counts on Sundays
+def evaluate_rules(short_term_parking, free_parking, night_parking, minute, sunday):
+    if short_term_parking is not None:
+        hours = parse_hours(short_term_parking)
+        if hours is None and short_term_parking == 'NO':
+            return False, False
+        if hours is not None and not within(hours, minute):
+            return False, False
+    if night_parking is False and is_night(minute):
+        return False, False
+    free_hours = parse_hours(free_parking)
+    return True, bool(sunday and free_hours is not None and within(free_hours, minute))
+
+# Scores a batch of (distance_in_km, feature) candidates column by column
+# Returns (scores, distances, effective_lots, free, features) for the usable carparks
+def score_candidates(candidates, radius_km, minute, sunday, rules, vehicle_height, expected, own_carpark):
+    distances = []
+    effective_lots = []
+    free = []
+    features = []
+    for distance, feature in candidates:
+        gantry_height = feature.get('gantry_height')
+        if vehicle_height is not None and gantry_height and gantry_height < vehicle_height:
+            continue
+        key = (feature.get('short_term_parking'), feature.get('free_parking'), feature.get('night_parking'))
+        rule = rules.get(key)
+        if rule is None:
+            rule = rules[key] = evaluate_rules(*key, minute, sunday)
+        if not rule[0]:
+            continue
+
+        competing = feature['no_of_interested_drivers'] or 0
+        if feature['car_park_no'] == own_carpark and competing:
+            competing -= 1
+        lots_available = expected(feature) if expected is not None else feature['lots_available']
+        distances.append(distance)
+        effective_lots.append(max(0, lots_available - competing))
+        free.append(rule[1])
+        features.append(feature)
+
+    lots_scores = [LOTS_WEIGHT * min(lots, ENOUGH_LOTS) / ENOUGH_LOTS for lots in effective_lots]
+    distance_scores = [DISTANCE_WEIGHT * distance / radius_km for distance in distances]
+    scores = [lots - distance + (FREE_PARKING_WEIGHT if is_free else 0)
+              for lots, distance, is_free in zip(lots_scores, distance_scores, free)]
+    return scores, distances, effective_lots, free, features
+
+# Returns the best `limit` carparks within radius_km of (lat, lon) in the snapshot, best
+# first, as (score, distance_in_km, effective_lots, free, feature)
+# Carparks are scored ring by ring from the spatial index, nearest first, into a heap of
+# the best `limit` so far. Nothing in a ring can score more than MAX_SCORE minus its
+# distance, so the search stops at the first ring that can't beat the worst of the heap.
+# expected, if given, is called with a feature for the lots available at arrival
+# own_carpark is the driver's interested carpark, where they don't compete with themselves
+def recommend(snapshot, lat, lon, radius_km, arrival, limit=5, vehicle_height=None, expected=None,
+              own_carpark=None):
+    local = datetime.fromtimestamp(arrival, SINGAPORE)
+    minute = local.hour * 60 + local.minute
+    sunday = local.weekday() == 6
+
+    # Carparks share a handful of rule combinations, each is evaluated once per request
+    rules = {}
+    best = []  # min-heap of (score, -distance, tie breaker, entry)
+    for min_distance, candidates in snapshot.index.rings(snapshot.by_number, lat, lon, radius_km):
+        if len(best) == limit and best[0][0] >= MAX_SCORE - DISTANCE_WEIGHT * min_distance / radius_km:
+            break
+        scores, distances, effective_lots, free, features = score_candidates(
+            candidates, radius_km, minute, sunday, rules, vehicle_height, expected, own_carpark)
+        for i, score in enumerate(scores):
+            if len(best) == limit and score <= best[0][0]:
+                continue
+            item = (score, -distances[i], features[i]['car_park_no'],
+                    (score, distances[i], effective_lots[i], free[i], features[i]))
+            if len(best) < limit:
+                heapq.heappush(best, item)
+            else:
+                heapq.heapreplace(best, item)
+    return [item[3] for item in sorted(best, reverse=True)]
@@ -0,0 +1,167 @@
+import os
+import random
+import traceback
+from threading import Event, Lock, Thread
+from time import monotonic, time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Non-blocking, process-wide lock on a file. Once acquired it is held until the
+# process exits, so with several workers (e.g. gunicorn -w 4) on one host only
+# one of them is the leader for a job, and another takes over if it dies
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        if self.file is not None:
+            return True
+        f = open(self.path, 'a')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        self.file = f
+        return True
+
+class Job:
+    def __init__(self, name, interval, target, jitter=0.1, backoff=30, leader_only=False):
+        self.name = name
+        self.interval = interval
+        self.target = target
+        self.jitter = jitter        # up to this fraction of the interval is added to each run
+        self.backoff = backoff      # seconds before the first retry, doubled on every failure
+        self.leader_only = leader_only
+        self.lock = None
+        self.is_leader = not leader_only
+
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.consecutive_failures = 0
+        self.last_run_at = None
+        self.last_duration = None
+        self.total_duration = 0
+        self.last_error = None
+        self.next_run_at = None
+
+    # Returns (slot, delay): the slot the next run belongs to and the seconds to wait for it
+    # Slots are a fixed rate from when the job started, each one interval after the
+    # previous, so runs don't drift by the time the job takes or the jitter of earlier
+    # runs. Missed slots are skipped. Jitter and backoff only delay the run within its
+    # slot, and a failed run is retried without moving on to the next slot.
+    def next_run(self, scheduled, now):
+        if self.consecutive_failures:
+            delay = min(self.backoff * 2 ** (self.consecutive_failures - 1), self.interval)
+            return scheduled, delay + random.uniform(0, self.jitter * delay)
+
+        scheduled += self.interval
+        if scheduled < now:
+            scheduled += ((now - scheduled) // self.interval + 1) * self.interval
+        return scheduled, scheduled - now + random.uniform(0, self.jitter * self.interval)
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'is_leader': self.is_leader,
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'consecutive_failures': self.consecutive_failures,
+            'last_run_at': self.last_run_at,
+            'last_duration': self.last_duration,
+            'total_duration': self.total_duration,
+            'last_error': self.last_error,
+            'next_run_at': self.next_run_at,
+        }
+
+# Seconds between the attempts of a process that isn't the leader to take over a
+# leader_only job, whatever the job's interval, so a daily job isn't left unrun for
+# up to a day when its leader dies
+LEADER_RETRY_INTERVAL = 30
+
+# Runs each job periodically in its own daemon thread, inside an app context
+# A job that raises is retried with exponential backoff instead of killing its thread
+class Scheduler:
+    def __init__(self, app, lock_dir=None):
+        self.app = app
+        self.lock_dir = lock_dir or app.instance_path
+        self.jobs = {}
+        self.threads = []
+        self.stopped = Event()
+        self.stats_lock = Lock()
+
+    # Jobs with leader_only=True only run in the process holding the job's lock file
+    def add_job(self, name, interval, target, **kwargs):
+        job = Job(name, interval, target, **kwargs)
+        if job.leader_only:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            job.lock = FileLock(os.path.join(self.lock_dir, f"{name}.lock"))
+        self.jobs[name] = job
+        return job
+
+    def start(self):
+        for job in self.jobs.values():
+            thread = Thread(target=self.run_job_forever, args=(job,), name=f"job-{job.name}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+
+    def run_job_forever(self, job):
+        scheduled = monotonic()
+        while not self.stopped.is_set():
+            self.run_job_once(job)
+            now = monotonic()
+            if job.is_leader:
+                scheduled, delay = job.next_run(scheduled, now)
+            else:
+                # Runs as soon as it takes over, the slots then start from there
+                scheduled, delay = now, LEADER_RETRY_INTERVAL
+            with self.stats_lock:
+                job.next_run_at = time() + delay
+            self.stopped.wait(delay)
+
+    def run_job_once(self, job):
+        if job.lock is not None and not job.is_leader:
+            job.is_leader = job.lock.acquire()
+            if not job.is_leader:
+                with self.stats_lock:
+                    job.skipped += 1
+                return
+
+        started_at = time()
+        start = monotonic()
+        error = None
+        try:
+            with self.app.app_context():
+                job.target()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            self.app.logger.error(f"Job {job.name} failed:\n{traceback.format_exc()}")
+
+        with self.stats_lock:
+            job.runs += 1
+            job.last_run_at = started_at
+            job.last_duration = monotonic() - start
+            job.total_duration += job.last_duration
+            job.last_error = error
+            if error:
+                job.failures += 1
+                job.consecutive_failures += 1
+            else:
+                job.consecutive_failures = 0
+
+    def stats(self):
+        with self.stats_lock:
+            return {name: job.stats() for name, job in self.jobs.items()}
@@ -0,0 +1,342 @@
+import gzip
+import hashlib
+import json
+import os
+from collections import deque
+from datetime import datetime, timezone
+from threading import Lock, Timer
+from time import time
+from .spatial import CarparkIndex
+from .clusters import ClusterIndex
+from .events import publish_snapshot_changes
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# Versions count from 1 in every process, so the ones given to clients are tokens of
+# "<epoch>:<version>" where the epoch is random per process. A token from another worker,
+# or from before a restart, then can't be mistaken for a version of this process.
+_epoch = None
+
+def get_epoch():
+    global _epoch
+    # A new epoch after a fork, e.g. gunicorn --preload, where every worker counts on its own
+    if _epoch is None or _epoch[0] != os.getpid():
+        _epoch = (os.getpid(), os.urandom(4).hex())
+    return _epoch[1]
+
+def version_token(version):
+    return f"{get_epoch()}:{version}"
+
+# Returns the version in a token from this process, or None
+def parse_version_token(token):
+    epoch, _, version = (token or '').partition(':')
+    if epoch != get_epoch():
+        return None
+    try:
+        return int(version)
+    except ValueError:
+        return None
+
+# An immutable view of the carparks served to drivers
+# A new snapshot is built for every refresh and swapped in as a whole, so readers
+# never see a half-updated list. The JSON body is serialized at most once per
+# snapshot and then sent as is by every request.
+class CarparkSnapshot:
+    __slots__ = ('version', 'created_at', 'last_modified', 'by_number', 'index',
+                 '_features', '_body', '_etag', '_encoded', '_by_lot_type', '_clusters', '_cluster_sums')
+
+    def __init__(self, version, features, body=None, created_at=None, last_modified=None):
+        self.version = version
+        self.created_at = created_at if created_at is not None else time()
+        self.last_modified = last_modified or datetime.fromtimestamp(self.created_at, timezone.utc)
+        self.by_number = {feature['car_park_no']: feature for feature in features}
+        self.index = CarparkIndex(self.by_number.values())
+        self._features = None
+        self._body = body
+        self._etag = None
+        self._encoded = {}
+        self._by_lot_type = {}
+        self._clusters = None
+        self._cluster_sums = None
+
+    # Returns a new snapshot where the given features (car_park_no -> feature) are replaced
+    # Only the dict of features is copied, the index is shared and the body is
+    # serialized again only when someone asks for it
+    def patch(self, features):
+        snapshot = object.__new__(CarparkSnapshot)
+        snapshot.version = self.version + 1
+        snapshot.created_at = time()
+        snapshot.last_modified = datetime.fromtimestamp(snapshot.created_at, timezone.utc)
+        snapshot.by_number = {**self.by_number, **features}
+        snapshot.index = self.index
+        snapshot._features = None
+        snapshot._body = None
+        snapshot._etag = None
+        snapshot._encoded = {}
+        snapshot._by_lot_type = {}
+        # The carparks didn't move, only the sums of the clusters have to be redone
+        snapshot._clusters = self._clusters
+        snapshot._cluster_sums = None
+        return snapshot
+
+    # Returns a snapshot of the carparks that have lots of the given type (e.g. 'Y' for
+    # motorcycles), with total_lots, lots_available and vacancy_percentage of that type
+    # It has the same version as this one and is built at most once per snapshot
+    def for_lot_type(self, lot_type):
+        snapshot = self._by_lot_type.get(lot_type)
+        if snapshot is None:
+            features = []
+            for feature in self.by_number.values():
+                lots = feature.get('lots', {}).get(lot_type)
+                if not lots:
+                    continue
+                total_lots, lots_available = lots
+                features.append({**feature, 'lot_type': lot_type, 'total_lots': total_lots,
+                                 'lots_available': lots_available,
+                                 'vacancy_percentage': int((lots_available/total_lots)*100)})
+            snapshot = CarparkSnapshot(self.version, features, created_at=self.created_at,
+                                       last_modified=self.last_modified)
+            self._by_lot_type[lot_type] = snapshot
+        return snapshot
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = tuple(self.by_number.values())
+        return self._features
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = json.dumps(self.features).encode()
+        return self._body
+
+    # The version given to clients, see version_token()
+    @property
+    def token(self):
+        return version_token(self.version)
+
+    # The version alone is not enough as it restarts from 1 with the app
+    @property
+    def etag(self):
+        if self._etag is None:
+            self._etag = f"{self.version}-{hashlib.sha1(self.body).hexdigest()[:16]}"
+        return self._etag
+
+    # Map clusters for every zoom level, see clusters.py
+    @property
+    def clusters(self):
+        if self._clusters is None:
+            self._clusters = ClusterIndex(self.by_number.values())
+        return self._clusters
+
+    # Returns the carparks and clusters to draw inside bbox at the zoom level
+    def clusters_in(self, bbox, zoom):
+        if self._cluster_sums is None:
+            self._cluster_sums = self.clusters.aggregate(self.by_number)
+        return self.clusters.get_clusters(self.by_number, self._cluster_sums, bbox, zoom)
+
+    def nearby(self, lat, lon, radius_km, sort='distance', limit=None, key=None):
+        return self.index.nearby(self.by_number, lat, lon, radius_km, sort=sort, limit=limit, key=key)
+
+    # Returns the body compressed with the given encoding ('gzip' or 'br')
+    # Each encoding is compressed at most once per snapshot, not once per request
+    def encoded(self, encoding):
+        body = self._encoded.get(encoding)
+        if body is None:
+            if encoding == 'gzip':
+                body = gzip.compress(self.body, compresslevel=9, mtime=0)
+            elif encoding == 'br' and brotli is not None:
+                body = brotli.compress(self.body)
+            else:
+                raise ValueError(f"Unsupported encoding: {encoding}")
+            self._encoded[encoding] = body
+        return body
+
+    # Sizes of the compressed bodies built so far, by encoding
+    def encoded_sizes(self):
+        return {encoding: len(body) for encoding, body in list(self._encoded.items())}
+
+    # Encodings that can be served, in order of preference
+    @staticmethod
+    def supported_encodings():
+        return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# Attributes that change between refreshes, these are the only ones sent in a change feed
+CHANGE_ATTRIBUTES = ('lots_available', 'vacancy_percentage', 'no_of_interested_drivers', 'lots')
+
+# Interest changes are published together at most once per PATCH_INTERVAL seconds,
+# see patch_snapshot_feature()
+PATCH_INTERVAL = 2
+
+# Seconds a client can fall behind before it has to refetch everything
+CHANGE_HISTORY_SECONDS = 60*60
+# Versions are published by the refreshes (availability every 5 minutes, followers check
+# once a minute) and by the interest patches, so this many versions always cover the hour
+MAX_CHANGE_HISTORY = CHANGE_HISTORY_SECONDS // PATCH_INTERVAL + CHANGE_HISTORY_SECONDS // 60
+
+# One entry per published version: (version, changed carparks, added features, removed carpark numbers, published at)
+# The entry for version v holds what changed between v - 1 and v
+_changes = deque(maxlen=MAX_CHANGE_HISTORY)
+
+_snapshot = CarparkSnapshot(0, [])
+_publish_lock = Lock()
+
+# Interest changes waiting to be published, car_park_no -> attributes to update
+_pending_patches = {}
+_pending_lock = Lock()
+_flush_timer = None
+
+def get_snapshot():
+    return _snapshot
+
+# Compares two snapshots and returns what a client holding `old` needs to become `new`
+def diff_snapshots(old, new):
+    changed = {}
+    added = {}
+    for car_park_no, feature in new.by_number.items():
+        old_feature = old.by_number.get(car_park_no)
+        if old_feature is None:
+            added[car_park_no] = feature
+        elif any(old_feature.get(a) != feature.get(a) for a in CHANGE_ATTRIBUTES):
+            changed[car_park_no] = {'car_park_no': car_park_no, **{a: feature.get(a) for a in CHANGE_ATTRIBUTES}}
+    removed = [car_park_no for car_park_no in old.by_number if car_park_no not in new.by_number]
+    return changed, added, removed
+
+# Returns the changes since the version token merged into one diff, or None if the client
+# has to refetch everything (version too old, from another process or from before a restart)
+def get_changes_since(token):
+    snapshot = _snapshot
+    version = parse_version_token(token)
+    if version is None:
+        return None
+    if version == snapshot.version:
+        return {'version': snapshot.token, 'changed': [], 'added': [], 'removed': []}
+    history = [entry for entry in list(_changes) if entry[0] <= snapshot.version]
+    if version > snapshot.version or not history or version < history[0][0] - 1:
+        return None
+
+    changed = {}
+    added = {}
+    removed = set()
+    for entry_version, entry_changed, entry_added, entry_removed, _ in history:
+        if entry_version <= version:
+            continue
+        for car_park_no, change in entry_changed.items():
+            if car_park_no in added:
+                added[car_park_no] = {**added[car_park_no], **change}
+            else:
+                changed[car_park_no] = change
+        for car_park_no, feature in entry_added.items():
+            added[car_park_no] = feature
+            changed.pop(car_park_no, None)
+            removed.discard(car_park_no)
+        for car_park_no in entry_removed:
+            changed.pop(car_park_no, None)
+            if added.pop(car_park_no, None) is None:
+                removed.add(car_park_no)
+
+    return {
+        'version': snapshot.token,
+        'changed': list(changed.values()),
+        'added': list(added.values()),
+        'removed': sorted(removed),
+    }
+
+# Must be called with _publish_lock held
+def record_changes(version, changed, added, removed):
+    now = time()
+    _changes.append((version, changed, added, removed, now))
+    while _changes[0][4] < now - CHANGE_HISTORY_SECONDS:
+        _changes.popleft()
+
+# Compress and cluster once when publishing, instead of on the first request
+def prepare_snapshot(snapshot):
+    for encoding in snapshot.supported_encodings():
+        snapshot.encoded(encoding)
+    snapshot.clusters_in((0, 0, 0, 0), 0)
+
+# Builds a new snapshot from the features and makes it the one served
+# If path is given the body is also written there (atomically) so that
+# it can be loaded again when the app restarts
+def publish_snapshot(features, path=None, last_modified=None):
+    global _snapshot
+    with _publish_lock:
+        old = _snapshot
+        snapshot = CarparkSnapshot(old.version + 1, features, last_modified=last_modified)
+        prepare_snapshot(snapshot)
+        changed, added, removed = diff_snapshots(old, snapshot)
+        record_changes(snapshot.version, changed, added, removed)
+        _snapshot = snapshot
+        publish_snapshot_changes(old, snapshot, changed, added, removed)
+    if path:
+        save_snapshot(snapshot, path)
+    return snapshot
+
+# Updates a few attributes of one carpark without rebuilding the snapshot,
+# e.g. patch_snapshot_feature('A1', no_of_interested_drivers=3)
+# The change is only queued here. The changes queued within PATCH_INTERVAL seconds are
+# published as one version by flush_snapshot_patches() on a timer thread, so that a click
+# doesn't copy every feature or leave the body to be compressed again by the next request.
+# Returns the updated feature, or None if the carpark is not in the snapshot
+def patch_snapshot_feature(car_park_no, **values):
+    global _flush_timer
+    feature = _snapshot.by_number.get(car_park_no)
+    if feature is None:
+        return None
+    with _pending_lock:
+        pending = _pending_patches.setdefault(car_park_no, {})
+        pending.update(values)
+        if _flush_timer is None:
+            _flush_timer = Timer(PATCH_INTERVAL, flush_snapshot_patches)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+        return {**feature, **pending}
+
+# Publishes the queued patches as one new version
+# Returns the new snapshot, or None if there was nothing to publish
+def flush_snapshot_patches():
+    global _snapshot, _flush_timer
+    with _pending_lock:
+        patches = dict(_pending_patches)
+        _pending_patches.clear()
+        _flush_timer = None
+
+    with _publish_lock:
+        old = _snapshot
+        features = {car_park_no: {**old.by_number[car_park_no], **values}
+                    for car_park_no, values in patches.items() if car_park_no in old.by_number}
+        if not features:
+            return None
+        snapshot = old.patch(features)
+        prepare_snapshot(snapshot)
+
+        changed = {car_park_no: {'car_park_no': car_park_no, **{a: feature.get(a) for a in CHANGE_ATTRIBUTES}}
+                   for car_park_no, feature in features.items()}
+        record_changes(snapshot.version, changed, {}, [])
+        _snapshot = snapshot
+        publish_snapshot_changes(old, snapshot, changed, {}, [])
+    return snapshot
+
+def save_snapshot(snapshot, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(snapshot.body)
+    os.replace(tmp_path, path)
+
+# Serve the carparks saved by a previous run until the first refresh finishes
+def load_snapshot(path):
+    global _snapshot
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        body = f.read()
+    with _publish_lock:
+        if _snapshot.version != 0:
+            return None
+        _snapshot = CarparkSnapshot(1, json.loads(body), body=body,
+                                    created_at=os.path.getmtime(path))
+    return _snapshot
@@ -0,0 +1,106 @@
+import heapq
+import math
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE = 111.32
+
+# Each grid cell is about 1.1km x 1.1km in Singapore, which keeps the number
+# of carparks per cell small while a 1-5km search only touches a few cells
+CELL_SIZE_DEG = 0.01
+
+# Returns distance between 2 (lat, lon) points in KM
+def haversine(lat1, lon1, lat2, lon2):
+    d_lat = math.radians(lat2 - lat1)
+    d_lon = math.radians(lon2 - lon1)
+    a = math.sin(d_lat / 2) ** 2 + \
+        math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def _cell(lat, lon, cell_size):
+    return (math.floor(lat / cell_size), math.floor(lon / cell_size))
+
+# Grid bucket index over carpark features (the same dicts served by /carparks)
+# A query only looks at the cells overlapping the search radius, so the cost
+# depends on the number of carparks nearby and not on the total number of carparks
+# Only positions and carpark numbers are indexed, the features are looked up in
+# `features` (car_park_no -> feature) at query time so they can change without a rebuild
+class CarparkIndex:
+    def __init__(self, features, cell_size=CELL_SIZE_DEG):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.size = 0
+        for feature in features:
+            lon, lat = feature['coordinates']
+            if lat is None or lon is None:
+                continue
+            self.cells.setdefault(_cell(lat, lon, cell_size), []).append((lat, lon, feature['car_park_no']))
+            self.size += 1
+        # Populated extent of the grid, a search never looks at cells outside of it
+        rows = [row for row, _ in self.cells]
+        cols = [col for _, col in self.cells]
+        self.min_row, self.max_row = (min(rows), max(rows)) if rows else (0, -1)
+        self.min_col, self.max_col = (min(cols), max(cols)) if cols else (0, -1)
+
+    # Returns a list of (distance_in_km, feature) within radius_km of (lat, lon)
+    def within(self, features, lat, lon, radius_km):
+        lat_span = math.ceil(radius_km / KM_PER_DEGREE / self.cell_size)
+        lon_km_per_degree = KM_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6)
+        lon_span = math.ceil(radius_km / lon_km_per_degree / self.cell_size)
+        center_row, center_col = _cell(lat, lon, self.cell_size)
+
+        results = []
+        for row in range(max(center_row - lat_span, self.min_row), min(center_row + lat_span, self.max_row) + 1):
+            for col in range(max(center_col - lon_span, self.min_col), min(center_col + lon_span, self.max_col) + 1):
+                for c_lat, c_lon, car_park_no in self.cells.get((row, col), ()):
+                    distance = haversine(lat, lon, c_lat, c_lon)
+                    if distance <= radius_km and car_park_no in features:
+                        results.append((distance, features[car_park_no]))
+        return results
+
+    # Yields (min_distance_km, results) for rings of cells around (lat, lon), nearest first
+    # results are the (distance_in_km, feature) within radius_km in that ring and every one
+    # of them is at least min_distance_km away, so a caller can stop once it is far enough
+    def rings(self, features, lat, lon, radius_km):
+        lat_span = math.ceil(radius_km / KM_PER_DEGREE / self.cell_size)
+        lon_km_per_degree = KM_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6)
+        lon_span = math.ceil(radius_km / lon_km_per_degree / self.cell_size)
+        # Narrowest a cell is as haversine measures it, with 1% to spare for the curvature
+        # across the search square, so min_distance_km is never more than the real distance
+        cell_km = 0.99 * math.radians(self.cell_size) * EARTH_RADIUS_KM * max(math.cos(math.radians(lat)), 1e-6)
+        center_row, center_col = _cell(lat, lon, self.cell_size)
+
+        # Only the part of the search square inside the populated extent is scanned
+        first_row, last_row = max(center_row - lat_span, self.min_row), min(center_row + lat_span, self.max_row)
+        first_col, last_col = max(center_col - lon_span, self.min_col), min(center_col + lon_span, self.max_col)
+        if first_row > last_row or first_col > last_col:
+            return
+        last_ring = max(center_row - first_row, last_row - center_row, center_col - first_col, last_col - center_col)
+
+        for ring in range(last_ring + 1):
+            results = []
+            for row in range(max(center_row - ring, first_row), min(center_row + ring, last_row) + 1):
+                if abs(row - center_row) == ring:
+                    cols = range(max(center_col - ring, first_col), min(center_col + ring, last_col) + 1)
+                else:
+                    cols = [col for col in {center_col - ring, center_col + ring} if first_col <= col <= last_col]
+                for col in cols:
+                    for c_lat, c_lon, car_park_no in self.cells.get((row, col), ()):
+                        distance = haversine(lat, lon, c_lat, c_lon)
+                        if distance <= radius_km and car_park_no in features:
+                            results.append((distance, features[car_park_no]))
+            yield max(0, ring - 1) * cell_km, results
+
+    # sort is either 'distance' (nearest first) or 'vacancy' (emptiest first)
+    # limit keeps only the top entries using a heap instead of a full sort
+    # key, if given, replaces the sort order and is called with (distance, feature) pairs
+    def nearby(self, features, lat, lon, radius_km, sort='distance', limit=None, key=None):
+        results = self.within(features, lat, lon, radius_km)
+        if key is None and sort == 'vacancy':
+            key = lambda r: (-r[1]['vacancy_percentage'], r[0])
+        elif key is None:
+            key = lambda r: r[0]
+
+        if limit is not None and limit < len(results):
+            return heapq.nsmallest(limit, results, key=key)
+        results.sort(key=key)
+        return results
@@ -1,8 +1,13 @@
-import { waitTillTargetReady, haversine } from "./helper.js";
+import { waitTillTargetReady } from "./helper.js";
 import { isCarparksReady, updateRouteUI } from "./map.js";
 import { Subject } from "./designpatterns.js";
 import { updateInterestedCarparkUI, updateIHaveParkedButtonUI } from "./sidebar.js";
 
+// Without a stream (e.g. the server already has as many as it allows), changes are polled
+// this often, and a stream is asked for again after STREAM_RETRY_POLLS polls
+const POLL_INTERVAL_MS = 30000;
+const STREAM_RETRY_POLLS = 4;
+
 
 export class Carpark extends Subject {
   constructor(coordinates, address, car_park_no, car_park_type,
@@ -22,6 +27,14 @@ export class Carpark extends Subject {
     this.type_of_parking_system = type_of_parking_system;
     this.vacancy_percentage = vacancy_percentage;
     this.distance_in_km = null;
+    // lot type the availability above is for, and the availability of every lot type
+    // ({ C: [total_lots, lots_available], Y: [...] }), filled in by update()
+    this.lot_type = null;
+    this.lots = {};
+    // parking rules and gantry height (in metres, 0 without a gantry), filled in by update()
+    this.short_term_parking = null;
+    this.night_parking = null;
+    this.gantry_height = null;
   }
 
   // Update carpark information by a list of name value pairs
@@ -54,6 +67,9 @@ export default class CarparkData extends Subject {
     this.interestedCarpark = null;
     this.interestedCarparkNo = window.interestedCarparkNo === "None" ? null : window.interestedCarparkNo;
     this.nearbyCarparks = null;
+    this.carparksVersion = null; // version token of the server snapshot the carparks were loaded from
+    this.eventSource = null;
+    this.pollTimer = null;
   }
 
   initializeCarparksFromJson(carparksInJson) {
@@ -79,6 +95,127 @@ export default class CarparkData extends Subject {
     }
   }
 
+  // Replace the carparks with a full list from the server, keeping the existing
+  // Carpark objects (and their observers) for carparks that are still there
+  syncCarparksFromJson(carparksInJson) {
+    const carparkDict = {};
+    const carparkList = [];
+
+    for (let carparkInJson of carparksInJson) {
+      let carpark = this.carparkDict[carparkInJson.car_park_no];
+      if (carpark) {
+        carpark.update(carparkInJson);
+      } else {
+        const { coordinates, address, car_park_no, car_park_type,
+          free_parking, lots_available, no_of_interested_drivers,
+          total_lots, type_of_parking_system, vacancy_percentage,
+        } = carparkInJson;
+
+        carpark = new Carpark(coordinates, address, car_park_no,
+          car_park_type, free_parking, lots_available,
+          no_of_interested_drivers, total_lots, type_of_parking_system,
+          vacancy_percentage, null);
+      }
+      carparkList.push(carpark);
+      carparkDict[carpark.car_park_no] = carpark;
+    }
+
+    this.carparkList = carparkList;
+    this.carparkDict = carparkDict;
+  }
+
+  // Ask the server for the carparks that changed since our version and patch them in.
+  // Falls back to fetching every carpark if we are too far behind or carparks were added/removed
+  async applyCarparkChanges() {
+    if (this.carparksVersion === null) return;
+
+    try {
+      let response = await fetch(`/carparks/changes?since=${encodeURIComponent(this.carparksVersion)}`, {
+        method: "GET"
+      });
+      const { version, full_refetch, changed, added, removed } = await response.json();
+
+      if (full_refetch || added.length > 0 || removed.length > 0) {
+        response = await fetch("/carparks", {
+          method: "GET"
+        });
+        this.syncCarparksFromJson(await response.json());
+        this.carparksVersion = response.headers.get("X-Carparks-Version");
+      } else if (changed.length > 0) {
+        this.updateCarparksFromJson(changed);
+        this.carparksVersion = version;
+      } else {
+        this.carparksVersion = version;
+        return;
+      }
+
+      if (isCarparksReady(this.App)) {
+        this.App.map.getSource("carparks-data").setData({
+          type: "geojson",
+          ...generateGeojsonData(this.carparkList)
+        });
+      }
+    } catch (error) {
+      return console.error(error);
+    }
+  }
+
+  // Listen for the availability and interest changes the server pushes for the carparks
+  // inside bbox ([minLng, minLat, maxLng, maxLat]). Only the visible carparks are patched
+  // this way, so carparksVersion is left to applyCarparkChanges which catches up everything
+  subscribeToCarparkChanges(bbox) {
+    if (this.eventSource) this.eventSource.close();
+    this.stopPollingCarparkChanges();
+
+    const params = new URLSearchParams({ bbox: bbox.join(",") });
+    const eventSource = new EventSource(`/carparks/stream?${params}`);
+    this.eventSource = eventSource;
+
+    // The browser reconnects by itself after a dropped connection, but an error response
+    // (e.g. a 503 when the server has too many streams) closes the EventSource for good
+    eventSource.onerror = () => {
+      if (eventSource.readyState !== EventSource.CLOSED || this.eventSource !== eventSource) return;
+      this.eventSource = null;
+      this.pollCarparkChanges(bbox);
+    };
+
+    this.eventSource.onmessage = (event) => {
+      const { full_refetch, changed } = JSON.parse(event.data);
+
+      if (full_refetch) {
+        this.applyCarparkChanges();
+        return;
+      }
+
+      const knownChanges = changed.filter((change) => this.carparkDict[change.car_park_no]);
+      if (knownChanges.length === 0) return;
+
+      this.updateCarparksFromJson(knownChanges);
+      if (isCarparksReady(this.App)) {
+        this.App.map.getSource("carparks-data").setData({
+          type: "geojson",
+          ...generateGeojsonData(this.carparkList)
+        });
+      }
+    };
+  }
+
+  pollCarparkChanges(bbox) {
+    let polls = 0;
+    this.pollTimer = setInterval(() => {
+      polls += 1;
+      if (polls >= STREAM_RETRY_POLLS) {
+        this.subscribeToCarparkChanges(bbox);
+      }
+      this.applyCarparkChanges();
+    }, POLL_INTERVAL_MS);
+  }
+
+  stopPollingCarparkChanges() {
+    clearInterval(this.pollTimer);
+    this.pollTimer = null;
+  }
+
   findCarparkFromNo(carparkNo) {
     if (!carparkNo) {
       console.error("carparkNo is null. Invalid.");
@@ -98,19 +235,30 @@ export default class CarparkData extends Subject {
     this.notifyObservers(this.nearbyCarparks, "nearby-carpark-list-update")
   }
 
+  // The search itself is done by the server using its spatial index
   async findNearbyCarparks(coordinates, radiusInKm) {
     const nearbyCarparks = [];
 
     await waitTillTargetReady(() => isCarparksReady(this.App), 100);
 
-    for (let carpark of this.carparkList) {
-      const distance = haversine(coordinates, carpark.coordinates).toFixed(1);
-      if (distance <= radiusInKm) {
-        carpark.distance_in_km = distance;
-        nearbyCarparks.push(carpark);
-      }
+    const params = new URLSearchParams({
+      lat: coordinates[1],
+      lon: coordinates[0],
+      radius_km: radiusInKm,
+    });
+    const response = await fetch(`/carparks/nearby?${params}`, {
+      method: "GET"
+    });
+    const nearbyCarparksInJson = await response.json();
+
+    for (let carparkInJson of nearbyCarparksInJson) {
+      const carpark = this.carparkDict[carparkInJson.car_park_no];
+      if (!carpark) continue;
+
+      carpark.distance_in_km = carparkInJson.distance_in_km.toFixed(1);
+      nearbyCarparks.push(carpark);
     }
-    
+
     return nearbyCarparks;
   }
 
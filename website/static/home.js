@@ -71,7 +71,7 @@ async function search() {
 
     placeSearchMarkerUI(App, coordinates, data.features[0].place_name);
     centerMapUI(App, coordinates, radiusInKm);
-    App.carparkData.updateNearbyCarparks(coordinates, radiusInKm);
+    await App.carparkData.updateNearbyCarparks(coordinates, radiusInKm);
 
     // if user is searching for the first time
     if (App.sortType === null) {
@@ -95,6 +95,7 @@ async function initialSetupUI() {
   const data = await response.json();
 
   await App.carparkData.initializeCarparksFromJson(data);
+  App.carparkData.carparksVersion = response.headers.get("X-Carparks-Version");
 
   loadGeoJSONData(App);
 
@@ -110,7 +111,21 @@ async function initialSetupUI() {
   updateRouteUI(App);
 }
 
-initialSetupUI();
+initialSetupUI().then(() => subscribeToVisibleCarparks());
+
+// Changes are pushed by the server for the carparks on screen only, so
+// resubscribe when the map moves and catch up on what we didn't hear about
+function subscribeToVisibleCarparks() {
+  const bounds = App.map.getBounds();
+  App.carparkData.subscribeToCarparkChanges([bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()]);
+  App.carparkData.applyCarparkChanges();
+}
+
+let resubscribeTimeout = null;
+App.map.on("moveend", function () {
+  clearTimeout(resubscribeTimeout);
+  resubscribeTimeout = setTimeout(subscribeToVisibleCarparks, 1000);
+});
 
 
 // The radius input also controls the map zoom level
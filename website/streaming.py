@@ -0,0 +1,116 @@
+import codecs
+import json
+
+try:
+    import ijson
+except ImportError:  # ijson is optional, the parser below is used without it
+    ijson = None
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+
+# Yields the values at `prefix` in a JSON document read from a binary file object,
+# without loading the whole document. The prefix uses ijson's syntax: keys separated
+# by dots, with 'item' standing for every element of an array, e.g.
+#   iter_json_items(f, 'result.records.item')
+# Only one value (e.g. one record) is kept in memory at a time.
+def iter_json_items(fileobj, prefix):
+    if ijson is not None:
+        return ijson.items(fileobj, prefix, use_float=True)
+    return JSONStream(fileobj).items(prefix.split('.') if prefix else [])
+
+# Minimal incremental reader used when ijson is not installed
+# It only walks the objects and arrays on the way to the prefix itself, every value
+# at the prefix (or skipped on the way) is decoded with json's raw_decode
+class JSONStream:
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        if self.eof:
+            return False
+        chunk = self.fileobj.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.buffer += self.text_decoder.decode(b'', final=True)
+            return True
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        # Drop what was consumed so the buffer stays around one chunk long
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(f"Expected one of {chars!r} at position {self.pos}, got {char!r}")
+        self.pos += 1
+        return char
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.read_more():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and not self.eof:
+                self.read_more()
+                continue
+            self.pos = end
+            return value
+
+    def items(self, path):
+        if not path:
+            yield self.read_value()
+            return
+
+        key, rest = path[0], path[1:]
+        if key == 'item':
+            if self.peek() != '[':
+                self.read_value()
+                return
+            self.pos += 1
+            if self.peek() == ']':
+                self.pos += 1
+                return
+            while True:
+                yield from self.items(rest)
+                if self.expect(',]') == ']':
+                    return
+
+        if self.peek() != '{':
+            self.read_value()
+            return
+        self.pos += 1
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            name = self.read_value()
+            self.expect(':')
+            if name == key:
+                yield from self.items(rest)
+            else:
+                self.read_value()
+            if self.expect(',}') == '}':
+                return
@@ -1,18 +1,18 @@
+import hashlib
 import json
-import pyproj
-import urllib.request
+import logging
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+from .projection import svy21_to_wgs84_batch
+from .streaming import iter_json_items
+from .history import record_availability_sample
+from .forecast import observe_availability
+
+SINGAPORE_TZ = timezone(timedelta(hours=8))
+
+logger = logging.getLogger(__name__)
 
-# (x, y) is also known as (easting, northing)
-def svy21_to_wgs84(x, y):
-    try:
-        x, y = svy21_to_wgs84.transformer.transform(x, y)
-    except AttributeError:
-        svy21_to_wgs84.svy21 = pyproj.CRS.from_proj4("+proj=tmerc +lat_0=1.366666666666667 +lon_0=103.83333333333333 +k_0=1.0 +x_0=28001.642 +y_0=38744.572 +ellps=WGS84 +units=m +no_defs")
-        svy21_to_wgs84.wgs84 = pyproj.CRS.from_proj4("+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs")
-        svy21_to_wgs84.transformer = pyproj.Transformer.from_crs(svy21_to_wgs84.svy21, svy21_to_wgs84.wgs84)
-        x, y = svy21_to_wgs84.transformer.transform(x, y)
-    return y, x
-    
 # Format the carpark information to match the database
 def format_carpark_information(record):
     fattributes = list()
@@ -30,7 +30,7 @@ def format_carpark_information(record):
     elif np == "NO":
         fattributes.append(False)
     else:
-        print("Error")
+        logger.warning(f"Carpark {record[0]}: unknown night_parking {np!r}, skipped")
         return None
 
     fattributes.append(int(record[9]))
@@ -42,80 +42,275 @@ def format_carpark_information(record):
     elif cpb == "N":
         fattributes.append(False)
     else:
-        print("Error")
+        logger.warning(f"Carpark {record[0]}: unknown car_park_basement {cpb!r}, skipped")
         return None
     
     return fattributes
 
+# data.gov.sg timestamps (e.g. 2023-03-01T10:31:05) are in Singapore time without an offset
+def parse_update_datetime(value):
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=SINGAPORE_TZ)
+    return parsed.astimezone(timezone.utc)
+
+# Fingerprint of a raw record, used to tell whether a carpark changed since the last sync
+def hash_carpark_record(record):
+    return hashlib.sha1(json.dumps(record, separators=(',', ':')).encode()).hexdigest()
+
+# Number of rows written per bulk statement, so only one batch of records is held in memory
+WRITE_BATCH_SIZE = 500
+
+# Carparks are only tombstoned if the feed had at least this fraction of the carparks we
+# have. A feed without result.records, or one cut short, would otherwise delete them all.
+MIN_FEED_FRACTION = 0.9
+
+KEYS_IN_ORDER = ['car_park_no', 'address', 'x_coord', 'y_coord', 'car_park_type',
+                 'type_of_parking_system', 'short_term_parking', 'free_parking',
+                 'night_parking', 'car_park_decks', 'gantry_height', 'car_park_basement']
+
+# Returns the configured feed url and the upstream client's streamed response,
+# or None as the response if the feed hasn't changed since it was last processed
+def open_feed(config_key):
+    from flask import current_app
+    url = current_app.config[config_key]
+    return url, current_app.extensions['upstream'].get(url)
+
+def mark_feed_processed(url, response):
+    from flask import current_app
+    current_app.extensions['upstream'].mark_processed(url, response)
+
+# Yields the carpark information records one by one as they are parsed from the response
+def iter_carpark_records(fileobj):
+    for r in iter_json_items(fileobj, 'result.records.item'):
+        yield [r[k] for k in KEYS_IN_ORDER]
+
+RECORD_LENGTH = len(KEYS_IN_ORDER)
+
+# Returns the raw carpark records, each with its (latitude, longitude) appended, converted
+# for the whole batch in one go. update_carparks() then doesn't have to convert them.
+def with_coordinates(records):
+    coordinates = svy21_to_wgs84_batch([float(r[2]) for r in records], [float(r[3]) for r in records])
+    return [r + [latlon] for r, latlon in zip(records, coordinates)]
+
+# Writes one batch of new and changed carparks, with their coordinates converted in one go
+# unless they are already in `converted` (car_park_no -> (latitude, longitude))
+def write_carpark_batch(db, CarPark, to_insert, to_update, converted=None):
+    changed = to_insert + to_update
+    converted = converted or {}
+    missing = [fattributes for car_park_no, _, fattributes in changed if car_park_no not in converted]
+    missing_coordinates = iter(svy21_to_wgs84_batch(
+        [fattributes[1] for fattributes in missing],
+        [fattributes[2] for fattributes in missing]))
+    coordinates = [converted[car_park_no] if car_park_no in converted else next(missing_coordinates)
+                   for car_park_no, _, _ in changed]
+
+    rows = []
+    for (car_park_no, record_hash, fattributes), (lat, lon) in zip(changed, coordinates):
+        rows.append({
+            'car_park_no': car_park_no,
+            'address': fattributes[0],
+            'x_coord': fattributes[1],
+            'y_coord': fattributes[2],
+            'latitude': lat,
+            'longitude': lon,
+            'car_park_type': fattributes[3],
+            'type_of_parking_system': fattributes[4],
+            'short_term_parking': fattributes[5],
+            'free_parking': fattributes[6],
+            'night_parking': fattributes[7],
+            'car_park_decks': fattributes[8],
+            'gantry_height': fattributes[9],
+            'car_park_basement': fattributes[10],
+            'record_hash': record_hash,
+            'is_deleted': False,
+        })
+    insert_rows = rows[:len(to_insert)]
+    update_rows = rows[len(to_insert):]
+
+    if insert_rows:
+        # attributes below are not in the dataset being queried
+        for row in insert_rows:
+            row.update(total_lots=None, lots_available=None, lot_type=None,
+                       lot_info_last_updated=None, no_of_interested_drivers=0)
+        db.session.execute(db.insert(CarPark), insert_rows)
+    if update_rows:
+        db.session.execute(db.update(CarPark), update_rows)
+
 # HDB carpark information mainly consists of information that changes rarely
 # We only need to update once per day
-def update_carparks():
-    print("XXXXX Updating carparks XXXXXXXXXXXXXXXXXX")
+# Only the carparks whose record changed are written: new carparks are inserted,
+# changed carparks are updated and carparks missing from the dataset are tombstoned.
+# Records are streamed from the response and written in batches of WRITE_BATCH_SIZE,
+# all in one transaction.
+# records can be given by the caller, e.g. the ingestion pipeline, which also publishes
+# the snapshot itself (publish=False) and passes a write_lock: each batch is then written
+# and committed while holding it, so no transaction stays open while waiting for records.
+def update_carparks(records=None, publish=True, write_lock=None):
     from . import db
     from .models import CarPark
-    import csv
 
-    # There are 2196 carparks in Singapore currently, which is why I set the limit in the url to be 3000
-    url = "https://data.gov.sg/api/action/datastore_search?resource_id=139a3035-e624-4f56-b63f-89ae28d4ae4c&limit=3000"
+    response = None
+    if records is None:
+        url, response = open_feed('CARPARK_INFO_URL')
+        if response is None:
+            logger.info("Carparks: not modified since the last update")
+            return {'seen': 0, 'inserted': 0, 'updated': 0, 'deleted': 0, 'seconds': 0, 'not_modified': True}
+        records = iter_carpark_records(response.raw)
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
+    start = perf_counter()
+
+    # One SELECT for the fingerprints of every carpark we already have
+    current = {
+        row.car_park_no: (row.record_hash, row.is_deleted)
+        for row in db.session.execute(db.select(CarPark.car_park_no, CarPark.record_hash, CarPark.is_deleted))
     }
 
-    req = urllib.request.Request(url, headers=headers)
-    fileobj = urllib.request.urlopen(req)
-    json_data = json.load(fileobj)
+    to_insert = []
+    to_update = []
+    converted = {}  # car_park_no -> (latitude, longitude) of the batch, see with_coordinates()
+    inserted = 0
+    updated = 0
+    seen = set()
 
-    keys_in_order = ['car_park_no', 'address', 'x_coord', 'y_coord', 'car_park_type',
-                'type_of_parking_system', 'short_term_parking', 'free_parking',
-                'night_parking', 'car_park_decks', 'gantry_height', 'car_park_basement']
+    def write_batch():
+        if write_lock is None:
+            write_carpark_batch(db, CarPark, to_insert, to_update, converted)
+            return
+        with write_lock:
+            write_carpark_batch(db, CarPark, to_insert, to_update, converted)
+            db.session.commit()
 
-    records = [[r[k] for k in keys_in_order] for r in json_data["result"]["records"]]
+    try:
+        for record in records:
+            car_park_no = record[0]
+            if car_park_no in seen:
+                continue
+            seen.add(car_park_no)
 
-    for record in records:
-        carpark = CarPark.query.get(record[0])
+            record_hash = hash_carpark_record(record[:RECORD_LENGTH])
+            if car_park_no in current and current[car_park_no] == (record_hash, False):
+                continue
 
-        # Will only create and fill the database if it hasn't been created yet, won't update
-        # May need to delete and run main.py again if you wan to update
-        if not carpark:
             fattributes = format_carpark_information(record)
-            lat, lon = svy21_to_wgs84(fattributes[1], fattributes[2])
-            carpark = CarPark(
-                car_park_no = record[0],
-                address = fattributes[0],
-                x_coord = fattributes[1],
-                y_coord = fattributes[2],
-                latitude = lat,
-                longitude = lon,
-                car_park_type  = fattributes[3],
-                type_of_parking_system = fattributes[4],
-                short_term_parking = fattributes[5],
-                free_parking = fattributes[6],
-                night_parking = fattributes[7],
-                car_park_decks = fattributes[8],
-                gantry_height = fattributes[9],
-                car_park_basement = fattributes[10],
-                # attributes below are not in the dataset being queried
-                total_lots = None,
-                lots_available = None,
-                lot_type = None,
-                lot_info_last_updated = None,
-                no_of_interested_drivers = 0
-            )
-            db.session.add(carpark)
-    
-    db.session.commit()
+            if fattributes is None:
+                continue
+            if car_park_no in current:
+                to_update.append((car_park_no, record_hash, fattributes))
+            else:
+                to_insert.append((car_park_no, record_hash, fattributes))
+            if len(record) > RECORD_LENGTH:
+                converted[car_park_no] = record[RECORD_LENGTH]
+
+            if len(to_insert) + len(to_update) >= WRITE_BATCH_SIZE:
+                write_batch()
+                inserted += len(to_insert)
+                updated += len(to_update)
+                to_insert, to_update = [], []
+                converted.clear()
+    finally:
+        if response is not None:
+            response.close()
+
+    if to_insert or to_update:
+        write_batch()
+        inserted += len(to_insert)
+        updated += len(to_update)
 
+    live = sum(1 for _, is_deleted in current.values() if not is_deleted)
+    if len(seen) < live * MIN_FEED_FRACTION:
+        # The carparks already written are kept, but nothing is deleted or published and
+        # the feed isn't marked as processed, so the next run fetches it in full again
+        with write_lock or nullcontext():
+            if inserted or updated:
+                bump_carpark_generation()
+            db.session.commit()
+        logger.warning(f"Carparks: only {len(seen)} of {live} carparks in the feed, not deleting the missing ones")
+        return {'seen': len(seen), 'inserted': inserted, 'updated': updated, 'deleted': 0,
+                'seconds': round(perf_counter() - start, 4), 'incomplete': True}
+
+    to_delete = [car_park_no for car_park_no, (_, is_deleted) in current.items()
+                 if car_park_no not in seen and not is_deleted]
+    with write_lock or nullcontext():
+        if to_delete:
+            db.session.execute(
+                db.update(CarPark)
+                .where(CarPark.car_park_no.in_(to_delete))
+                .values(is_deleted=True)
+                .execution_options(synchronize_session=False))
+        if inserted or updated or to_delete:
+            bump_carpark_generation()
+        db.session.commit()
+    if response is not None:
+        mark_feed_processed(url, response)
+
+    stats = {
+        'seen': len(seen),
+        'inserted': inserted,
+        'updated': updated,
+        'deleted': len(to_delete),
+        'seconds': round(perf_counter() - start, 4),
+    }
+    logger.info(f"Carparks: {stats['seen']} seen, {stats['inserted']} inserted, {stats['updated']} updated, "
+                f"{stats['deleted']} deleted in {stats['seconds']}s")
+
+    # Changed carparks need to be searchable through the spatial index
+    if publish and (inserted or updated or to_delete):
+        generate_geojson()
+    return stats
+
+# Carpark generation (see CarParkGeneration) the snapshot of this process was built from
+_published_generation = None
+_published = False
+
+# Called in the transaction of every write to the carparks, so that the other processes
+# rebuild their snapshot, see refresh_snapshot_if_stale
+def bump_carpark_generation():
+    from . import db
+    from .models import CarParkGeneration
+    db.session.execute(db.update(CarParkGeneration)
+                       .where(CarParkGeneration.id == 1)
+                       .values(generation=CarParkGeneration.generation + 1))
+
+def carpark_generation():
+    from . import db
+    from .models import CarParkGeneration
+    return db.session.execute(db.select(CarParkGeneration.generation)
+                              .where(CarParkGeneration.id == 1)).scalar()
+
+# Builds the carpark features served to drivers and publishes them as the new snapshot
+# The snapshot is only written to disk if CARPARKS_JSON_PATH is configured
 def generate_geojson():
+    global _published_generation, _published
+    from flask import current_app
     from . import db
-    from .models import CarPark
-    import os
-    print("XXXXX Generating GeoJSON XXXXXXXXXXXXXXXXX")
+    from .models import CarPark, CarParkAvailability
+    from .snapshot import publish_snapshot
+    # Read before the carparks, so a write in between is picked up by the next refresh
+    generation = carpark_generation()
     carparks = CarPark.query.all()
+
+    # car_park_no -> {lot_type: [total_lots, lots_available]}
+    lots = {}
+    for row in db.session.execute(db.select(
+            CarParkAvailability.car_park_no, CarParkAvailability.lot_type,
+            CarParkAvailability.total_lots, CarParkAvailability.lots_available)):
+        if row.total_lots:
+            lots.setdefault(row.car_park_no, {})[row.lot_type] = [row.total_lots, row.lots_available]
     features = []
+    last_updated = None
     for carpark in carparks:
+        if carpark.is_deleted:
+            continue
         if carpark.lots_available is None or carpark.total_lots is None or carpark.total_lots==0:
             continue
+        if carpark.lot_info_last_updated and (last_updated is None or carpark.lot_info_last_updated > last_updated):
+            last_updated = carpark.lot_info_last_updated
         feature = {
                 'coordinates': [carpark.longitude, carpark.latitude],
                 'car_park_no': carpark.car_park_no,
@@ -126,50 +321,178 @@ def generate_geojson():
                 'car_park_type': carpark.car_park_type,
                 'type_of_parking_system': carpark.type_of_parking_system,
                 'free_parking': carpark.free_parking,
-                'no_of_interested_drivers': carpark.no_of_interested_drivers
+                'short_term_parking': carpark.short_term_parking,
+                'night_parking': carpark.night_parking,
+                'gantry_height': carpark.gantry_height,
+                'no_of_interested_drivers': carpark.no_of_interested_drivers,
+                'lot_type': carpark.lot_type,
+                'lots': lots.get(carpark.car_park_no, {})
         }
         features.append(feature)
-    geojson = features
 
-    json_str = json.dumps(geojson)
-    with open(os.path.join('website', 'carparks.json'), 'w') as f:
-        f.write(json_str)
-    abs_path = os.path.abspath('carparks.json')
-    print(f"GeoJSON file saved to: {abs_path}")
+    path = current_app.config.get('CARPARKS_JSON_PATH')
+    snapshot = publish_snapshot(features, path, last_modified=parse_update_datetime(last_updated))
+    _published_generation = generation
+    _published = True
+    observe_availability(features)
+    logger.info(f"GeoJSON snapshot {snapshot.version} published with {len(features)} carparks")
+    return snapshot
 
-def update_carparks_availability():
-    print("XXXXX Updating carparks availability XXXXX")
+# Publishes the snapshot after this process wrote an availability feed, if the write
+# changed anything or this process never published one
+# stats are the ones returned by update_carparks_availability
+def publish_availability_changes(stats):
+    if stats.get('changed') or stats.get('lot_types_changed') or not _published:
+        return generate_geojson()
+    return None
+
+# Rebuilds the snapshot if another process (or a request of this one) wrote to the carparks
+# since it was built. This is how the workers that don't fetch the feeds (see the leader_only
+# jobs) catch up with the feeds, and every worker with the interested drivers of the others.
+# Cheap enough to run often: it's a single primary key lookup when nothing changed
+def refresh_snapshot_if_stale():
+    if carpark_generation() != _published_generation:
+        return generate_geojson()
+    return None
+
+# Yields the availability records one by one as they are parsed from the response
+def iter_availability_records(fileobj):
+    return iter_json_items(fileobj, 'items.item.carpark_data.item')
+
+# Reads the availability feed, diffs it against what is in the database and writes
+# only what changed, in bulk statements of WRITE_BATCH_SIZE rows committed as one transaction.
+# Every lot type of a record goes to carpark_availability in the same pass, and the
+# first lot type is also kept on the carpark itself.
+# With a write_lock (the ingestion pipeline), each batch is committed on its own while holding it
+# Returns a summary of how many records were seen, changed and skipped
+def update_carparks_availability(records=None, write_lock=None):
     from . import db
-    from .models import CarPark
+    from .models import CarPark, CarParkAvailability
+
+    response = None
+    if records is None:
+        url, response = open_feed('CARPARK_AVAILABILITY_URL')
+        if response is None:
+            logger.info("Carpark availability: not modified since the last update")
+            return {'seen': 0, 'changed': 0, 'lot_types_changed': 0, 'skipped': 0, 'seconds': 0,
+                    'not_modified': True}
+        records = iter_availability_records(response.raw)
 
-    url = 'https://api.data.gov.sg/v1/transport/carpark-availability'
+    start = perf_counter()
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
+    # One SELECT for the current availability of every carpark, and one for every lot type
+    current = {
+        row.car_park_no: (row.total_lots, row.lots_available, row.lot_type, row.lot_info_last_updated)
+        for row in db.session.execute(db.select(
+            CarPark.car_park_no, CarPark.total_lots, CarPark.lots_available,
+            CarPark.lot_type, CarPark.lot_info_last_updated))
+    }
+    current_lots = {
+        (row.car_park_no, row.lot_type): (row.total_lots, row.lots_available, row.last_updated)
+        for row in db.session.execute(db.select(
+            CarParkAvailability.car_park_no, CarParkAvailability.lot_type, CarParkAvailability.total_lots,
+            CarParkAvailability.lots_available, CarParkAvailability.last_updated))
     }
 
-    req = urllib.request.Request(url, headers=headers)
-    fileobj = urllib.request.urlopen(req)
-    json_data = json.load(fileobj)
+    changes = {}
+    new_lots = []
+    changed_lots = []
+    changed = 0
+    lot_types_changed = 0
+    seen = 0
+    skipped = 0
 
-    records = json_data['items'][0]['carpark_data']
+    def flush():
+        # Bulk INSERT/UPDATE by primary key (executemany)
+        if changes:
+            db.session.execute(db.update(CarPark), list(changes.values()))
+        if new_lots:
+            db.session.execute(db.insert(CarParkAvailability), new_lots)
+        if changed_lots:
+            db.session.execute(db.update(CarParkAvailability), changed_lots)
 
-    for record in records:
-        carpark_info = record.get("carpark_info")[0]
+    def write_batch():
+        if write_lock is None:
+            flush()
+            return
+        with write_lock:
+            flush()
+            db.session.commit()
 
-        total_lots = int(carpark_info.get("total_lots"))
-        lots_available = int(carpark_info.get("lots_available"))
-        lot_type = carpark_info.get("lot_type")
-        lot_info_last_updated = record.get("update_datetime")
+    try:
+        for record in records:
+            seen += 1
+            carpark_no = record.get("carpark_number")
+
+            # update availability if the carpark exists in the database
+            # otherwise, omit
+            if carpark_no not in current:
+                skipped += 1
+                continue
+
+            update_datetime = record.get("update_datetime")
+            carpark_infos = record.get("carpark_info")
+            for carpark_info in carpark_infos:
+                lot_type = carpark_info.get("lot_type")
+                lot_values = (int(carpark_info.get("total_lots")), int(carpark_info.get("lots_available")),
+                              update_datetime)
+                key = (carpark_no, lot_type)
+                if current_lots.get(key) == lot_values:
+                    continue
+                row = {'car_park_no': carpark_no, 'lot_type': lot_type, 'total_lots': lot_values[0],
+                       'lots_available': lot_values[1], 'last_updated': update_datetime}
+                (changed_lots if key in current_lots else new_lots).append(row)
+                current_lots[key] = lot_values
 
-        carpark = CarPark.query.get(record.get("carpark_number"))
+            carpark_info = carpark_infos[0]
+            new_values = (
+                int(carpark_info.get("total_lots")),
+                int(carpark_info.get("lots_available")),
+                carpark_info.get("lot_type"),
+                update_datetime,
+            )
+            if new_values != current[carpark_no]:
+                # a carpark repeated in the feed is only written once, with its last values
+                current[carpark_no] = new_values
+                changes[carpark_no] = {
+                    'car_park_no': carpark_no,
+                    'total_lots': new_values[0],
+                    'lots_available': new_values[1],
+                    'lot_type': new_values[2],
+                    'lot_info_last_updated': new_values[3],
+                }
+
+            if len(changes) + len(new_lots) + len(changed_lots) >= WRITE_BATCH_SIZE:
+                write_batch()
+                changed += len(changes)
+                lot_types_changed += len(new_lots) + len(changed_lots)
+                changes.clear()
+                new_lots.clear()
+                changed_lots.clear()
+    finally:
+        if response is not None:
+            response.close()
 
-        # update availability if the carpark exists in the database
-        # otherwise, omit
-        if carpark:
-            carpark.total_lots = total_lots
-            carpark.lots_available = lots_available
-            carpark.lot_type = lot_type
-            carpark.lot_info_last_updated = lot_info_last_updated
+    changed += len(changes)
+    lot_types_changed += len(new_lots) + len(changed_lots)
+    with write_lock or nullcontext():
+        flush()
+        # Bumped with the last batch only, so other processes don't rebuild from a partial write
+        if changed or lot_types_changed:
+            bump_carpark_generation()
+        db.session.commit()
+        # current_lots now holds the availability of every lot type after this refresh
+        record_availability_sample(current_lots)
+    if response is not None:
+        mark_feed_processed(url, response)
 
-    db.session.commit()
\ No newline at end of file
+    stats = {
+        'seen': seen,
+        'changed': changed,
+        'lot_types_changed': lot_types_changed,
+        'skipped': skipped,
+        'seconds': round(perf_counter() - start, 4),
+    }
+    logger.info(f"Carpark availability: {stats['seen']} seen, {stats['changed']} changed "
+                f"({stats['lot_types_changed']} lot types), {stats['skipped']} skipped in {stats['seconds']}s")
+    return stats
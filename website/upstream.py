@@ -0,0 +1,99 @@
+import os
+import requests
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# There are 2196 carparks in Singapore currently, which is why I set the limit in the url to be 3000
+CARPARK_INFO_URL = "https://data.gov.sg/api/action/datastore_search?resource_id=139a3035-e624-4f56-b63f-89ae28d4ae4c&limit=3000"
+CARPARK_AVAILABILITY_URL = "https://api.data.gov.sg/v1/transport/carpark-availability"
+
+def default_upstream_config():
+    return {
+        # Point these at a local server to test without data.gov.sg
+        'CARPARK_INFO_URL': os.getenv('CARPARK_INFO_URL', CARPARK_INFO_URL),
+        'CARPARK_AVAILABILITY_URL': os.getenv('CARPARK_AVAILABILITY_URL', CARPARK_AVAILABILITY_URL),
+        'UPSTREAM_CONNECT_TIMEOUT': float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 5)),
+        'UPSTREAM_READ_TIMEOUT': float(os.getenv('UPSTREAM_READ_TIMEOUT', 30)),
+        'UPSTREAM_RETRIES': int(os.getenv('UPSTREAM_RETRIES', 3)),
+        # Seconds a whole feed (fetch and parse, retries included) may take in the ingestion pipeline
+        'UPSTREAM_FETCH_DEADLINE': float(os.getenv('UPSTREAM_FETCH_DEADLINE', 120)),
+    }
+
+# HTTP client shared by the refresh jobs, kept in app.extensions['upstream']
+# Connections are kept alive between refreshes, responses are gzip compressed and
+# requests that fail to connect or get a 429/5xx are retried with exponential backoff.
+# Feeds are fetched conditionally: if data.gov.sg answers 304 Not Modified, get()
+# returns None and the caller can skip its database work.
+class UpstreamClient:
+    def __init__(self, connect_timeout=5, read_timeout=30, retries=3, backoff_factor=0.5):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)',
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+        })
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=('GET',), respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # url -> (etag, last_modified) of the last response that was processed
+        self.validators = {}
+        # Both feeds are fetched at the same time (see pipeline.py), so the counts are
+        # only changed and read under stats_lock
+        self.stats = {'ok': 0, 'not_modified': 0, 'error': 0}
+        self.stats_lock = Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(connect_timeout=config['UPSTREAM_CONNECT_TIMEOUT'],
+                   read_timeout=config['UPSTREAM_READ_TIMEOUT'],
+                   retries=config['UPSTREAM_RETRIES'])
+
+    # Returns the streamed response, or None if the feed hasn't changed since the
+    # last response passed to mark_processed()
+    # The response's raw attribute is a file-like object of the decompressed body
+    def get(self, url):
+        headers = {}
+        etag, last_modified = self.validators.get(url, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout, stream=True)
+            if response.status_code == 304:
+                response.close()
+                self.count('not_modified')
+                return None
+            response.raise_for_status()
+        except requests.RequestException:
+            self.count('error')
+            raise
+        self.count('ok')
+        response.raw.decode_content = True
+        return response
+
+    def count(self, result):
+        with self.stats_lock:
+            self.stats[result] += 1
+
+    # Returns a copy of the request counts by result
+    def get_stats(self):
+        with self.stats_lock:
+            return dict(self.stats)
+
+    # Call once the response has been written to the database, so that a failed
+    # refresh fetches the whole feed again next time
+    def mark_processed(self, url, response):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            self.validators[url] = (etag, last_modified)
+
+    def close(self):
+        self.session.close()
@@ -1,11 +1,20 @@
-from flask import Blueprint, render_template, request, flash, jsonify, redirect, url_for
+from flask import Blueprint, render_template, request, flash, jsonify, redirect, url_for, Response, current_app
 from flask_login import current_user
 from . import db
 from .auth import role_required
 from .models import *
-from .update_carparks import update_carparks_availability, generate_geojson
+from .snapshot import get_snapshot, get_changes_since, patch_snapshot_feature
+from .events import broker
+from .identity import invalidate_identity
+from .history import get_availability_history, RESOLUTIONS, RETENTION, DAILY
+from .forecast import get_forecaster
+from .recommend import recommend
+from .clusters import level_for
+from .update_carparks import bump_carpark_generation
 from datetime import datetime, date
+from time import time
 import json
+import math
 import os
 
 MAPBOX_SECRET_KEY=os.getenv("MAPBOX_SECRET_KEY")
@@ -20,11 +29,9 @@ def home():
 @views.route('/map', methods=['GET'])
 @role_required('driver')
 def get_map():
-    has_vehicle = False
-    vehicles = Vehicle.query.filter_by(user_id = current_user.id).all()
-    if vehicles:
-        has_vehicle = True
-    driver = Driver.query.filter_by(user_id = current_user.id).first()
+    # loaded together with current_user, see identity.py
+    has_vehicle = current_user.has_vehicle
+    driver = current_user.driver
     interested_carpark = driver.interested_carpark
     return render_template("home.html", user=current_user, MAPBOX_SECRET_KEY=MAPBOX_SECRET_KEY, has_vehicle=has_vehicle, interested_carpark=interested_carpark, driver=driver)
 
@@ -71,6 +78,7 @@ def post_coe():
         new_vehicle = Vehicle(full_name=full_name, car_plate=car_plate, coe_expiry=coe_expiry, user_id=current_user.id)
         db.session.add(new_vehicle) 
         db.session.commit()
+        invalidate_identity(current_user.id)
         flash("Vehicle registered successfully!", "success")
         return redirect(url_for('views.get_registered_vehicles'))
     
@@ -86,28 +94,72 @@ def get_registered_vehicles():
         flash("You don't have any vehicles registered with us!", "error")
         return redirect(url_for('views.get_coe'))
 
+REWARDS_PER_PAGE = 20
+REWARD_CATEGORIES = ['Food', 'Fashion', 'Retail', 'Entertainment', 'Services', 'Travel', 'Others']
+
+# Returns one page of (reward, company_name, claimed_by_me) rows from a single joined query
+# Pages are keyed by reward id (after_id is the last id of the previous page), so a page
+# costs the same no matter how deep into the catalogue it is
+# Also returns the id to continue from, or None if this is the last page
+def query_rewards_page(after_id=None, category=None, claimant_user_id=None, owner_user_id=None,
+                       available_only=False, per_page=REWARDS_PER_PAGE):
+    if claimant_user_id is not None:
+        claimed_by_me = db.exists().where(UserClaimedRewards.reward_id == Reward.id,
+                                          UserClaimedRewards.driver_user_id == claimant_user_id)
+    else:
+        claimed_by_me = db.false()
+
+    query = (
+        db.select(Reward, Company.company_name, claimed_by_me.label('claimed_by_me'))
+        .outerjoin(Company, Company.user_id == Reward.user_id)
+        .order_by(Reward.id)
+        .limit(per_page + 1)
+    )
+    if after_id is not None:
+        query = query.where(Reward.id > after_id)
+    if category:
+        query = query.where(Reward.reward_category == category)
+    if owner_user_id is not None:
+        query = query.where(Reward.user_id == owner_user_id)
+    if available_only:
+        query = query.where(Reward.number_of_rewards > 0, Reward.reward_expiry >= date.today())
+
+    rows = db.session.execute(query).all()
+    next_after_id = rows[per_page - 1][0].id if len(rows) > per_page else None
+    return rows[:per_page], next_after_id
+
+# Returns the (reward, company_name) of every reward claimed by the driver, in one query
+def query_claimed_rewards(driver_user_id):
+    return db.session.execute(
+        db.select(Reward, Company.company_name)
+        .join(UserClaimedRewards, UserClaimedRewards.reward_id == Reward.id)
+        .outerjoin(Company, Company.user_id == Reward.user_id)
+        .where(UserClaimedRewards.driver_user_id == driver_user_id)
+        .order_by(UserClaimedRewards.id)
+    ).all()
+
 @views.route('/rewards', methods=['GET'])
 def get_rewards():
     if not current_user.is_authenticated:
-        # This doesn't work currently
-        return render_template(url_for("auth.get_driver_login"))
+        return redirect(url_for("auth.get_driver_login"))
+
+    after_id = request.args.get('after', type=int)
+    category = request.args.get('category')
+    if category not in REWARD_CATEGORIES:
+        category = None
+
     if current_user.user_type=="driver":
-        rewards = Reward.query.all()
-        companies = Company.query.all()
-        driver = Driver.query.filter_by(user_id=current_user.id).first()
-        user_claimed_rewards_query = UserClaimedRewards.query.filter_by(driver_user_id=current_user.id).all()
-        reward_id_list = [reward.reward_id for reward in user_claimed_rewards_query]
-        user_claimed_rewards = []
-        for id in reward_id_list:
-            temp = Reward.query.filter_by(id=id).first()
-            user_claimed_rewards.append(temp)
-        print(reward_id_list)
-        print(user_claimed_rewards)
-        return render_template("view_rewards.html", user=current_user, rewards=rewards, companies=companies, driver=driver, user_claimed_rewards=user_claimed_rewards)
+        driver = current_user.driver
+        rewards, next_after_id = query_rewards_page(after_id, category, claimant_user_id=current_user.id,
+                                                    available_only=True)
+        user_claimed_rewards = query_claimed_rewards(current_user.id)
+        return render_template("view_rewards.html", user=current_user, rewards=rewards, driver=driver,
+                               user_claimed_rewards=user_claimed_rewards, categories=REWARD_CATEGORIES,
+                               category=category, next_after_id=next_after_id)
     if current_user.user_type=="corporate":
-        rewards = Reward.query.all()
-        companies = Company.query.all()
-        return render_template("posted_rewards.html", user=current_user, rewards=rewards, companies=companies)
+        rewards, next_after_id = query_rewards_page(after_id, category, owner_user_id=current_user.id)
+        return render_template("posted_rewards.html", user=current_user, rewards=rewards,
+                               categories=REWARD_CATEGORIES, category=category, next_after_id=next_after_id)
 
 @views.route('/rewards', methods=['DELETE'])
 @role_required('corporate')
@@ -125,30 +177,46 @@ def delete_rewards():
 @role_required('driver')
 def claim_reward():
     reward_id = request.form['reward_id']
-    reward = Reward.query.get(reward_id)
-    driver = Driver.query.filter_by(user_id=current_user.id).first()
-    
-    # since 1 point =  10 cents, drivers need to have (cost of reward)*10 points
-    if driver.points >= reward.cost_of_reward*10 and reward.number_of_rewards > 0:
-        driver.points -= (reward.cost_of_reward)*10
-        new_claim = UserClaimedRewards(driver_user_id=current_user.id, reward_id=reward_id)
-        db.session.add(driver)
-        db.session.add(new_claim)
-        db.session.commit()
-
-        reward.number_of_rewards -= 1
-        db.session.add(reward)
-        db.session.commit()
+    reward = db.session.get(Reward, reward_id)
+    if reward is None:
+        flash("Sorry, this reward no longer exists!", "error")
+        return redirect(url_for('views.get_rewards'))
 
-        flash("You have successfully claimed the reward!", "success")
-    else:
+    # since 1 point =  10 cents, drivers need to have (cost of reward)*10 points
+    cost_in_points = reward.cost_of_reward*10
+
+    # Both counters are checked and changed by the database in the same statement,
+    # so concurrent claims can neither oversell a reward nor spend the same points twice
+    remaining = db.session.execute(
+        db.update(Reward)
+        .where(Reward.id == reward_id, Reward.number_of_rewards > 0)
+        .values(number_of_rewards=Reward.number_of_rewards - 1)
+        .returning(Reward.number_of_rewards)
+    ).first()
+    if remaining is None:
+        db.session.rollback()
+        flash("Sorry, this reward has been fully claimed!", "error")
+        return redirect(url_for('views.get_rewards'))
+
+    points = db.session.execute(
+        db.update(Driver)
+        .where(Driver.user_id == current_user.id, Driver.points >= cost_in_points)
+        .values(points=Driver.points - cost_in_points)
+        .returning(Driver.points)
+    ).first()
+    if points is None:
+        db.session.rollback()
         flash("Sorry, you do not have enough points to claim this reward!", "error")
-    
+        return redirect(url_for('views.get_rewards'))
+
+    db.session.add(UserClaimedRewards(driver_user_id=current_user.id, reward_id=reward.id))
+    db.session.commit()
+    invalidate_identity(current_user.id)
+    flash("You have successfully claimed the reward!", "success")
     return redirect(url_for('views.get_rewards'))
 
 @views.route('/rewards/use', methods=['DELETE'])
 def remove_user_rewards():
-    print("hello")
     reward = json.loads(request.data)
     rewardId = reward['rewardId']
     reward = UserClaimedRewards.query.filter_by(driver_user_id=current_user.id).filter_by(reward_id=rewardId).first()
@@ -216,7 +284,7 @@ def post_rewards_creation():
 @views.route('/points', methods=['GET'])
 @role_required('driver')
 def get_points():
-    driver = Driver.query.filter_by(user_id=current_user.id).first()
+    driver = current_user.driver
     return render_template("claim_points.html", user=current_user, driver = driver)
 
 @views.route('/points', methods=['PUT'])
@@ -224,9 +292,9 @@ def get_points():
 def put_points():
     request_body = json.loads(request.data)
     points_change = int(request_body["points_change"])  # Can also be negative
-    driver = Driver.query.filter_by(user_id = current_user.id).first()
-    driver.points += points_change
+    add_driver_points(current_user.id, points_change)
     db.session.commit()
+    invalidate_identity(current_user.id)
     return jsonify({})
 
 @views.route('/vehicles', methods=['DELETE'])
@@ -238,53 +306,116 @@ def delete_vehicles():
         if vehicle.user_id == current_user.id:
             db.session.delete(vehicle)
             db.session.commit()
+            invalidate_identity(current_user.id)
     return jsonify({})
 
+# Counters are changed with a single UPDATE ... RETURNING so that concurrent
+# requests can't overwrite each other's changes. Returns the new value, or None
+# if the row doesn't exist (or the counter would go below zero)
+def change_interested_drivers(car_park_no, delta):
+    conditions = [CarPark.car_park_no == car_park_no]
+    if delta < 0:
+        conditions.append(CarPark.no_of_interested_drivers >= -delta)
+    count = db.session.execute(
+        db.update(CarPark)
+        .where(*conditions)
+        .values(no_of_interested_drivers=CarPark.no_of_interested_drivers + delta)
+        .returning(CarPark.no_of_interested_drivers)
+    ).scalar()
+    # The other workers only see the new count once they rebuild their snapshot
+    if count is not None:
+        bump_carpark_generation()
+    return count
+
+def add_driver_points(user_id, delta):
+    return db.session.execute(
+        db.update(Driver)
+        .where(Driver.user_id == user_id)
+        .values(points=Driver.points + delta)
+        .returning(Driver.points)
+    ).scalar()
+
+# Changes the driver's interested carpark only if it is still `old`, so two requests
+# from the same driver can't both move their interest (and both change the counters)
+def swap_interested_carpark(user_id, old, new):
+    if old is None:
+        is_still_old = Driver.interested_carpark.is_(None)
+    else:
+        is_still_old = Driver.interested_carpark == old
+    return db.session.execute(
+        db.update(Driver)
+        .where(Driver.user_id == user_id, is_still_old)
+        .values(interested_carpark=new)
+        .returning(Driver.id)
+    ).first() is not None
+
 @views.route('/drivers', methods=['PUT'])
 @role_required('driver')
 def put_drivers():
     data = json.loads(request.data)
-    driver = Driver.query.filter_by(user_id = current_user.id).first()
+    driver = current_user.driver
     intent = data["intent"]
 
     if intent == "update_interested_carpark":
         carpark_address = data['carpark_address']
         carpark = CarPark.query.filter_by(address=carpark_address).first()
+        old_carpark_no = driver.interested_carpark
+        counts = {}
 
         # user is removing interest from an old carpark
         # op_type = 0 means user is removing interest
-        if carpark.car_park_no==driver.interested_carpark:
-            driver.interested_carpark = None
-            carpark.no_of_interested_drivers-=1
+        if carpark.car_park_no==old_carpark_no:
+            if not swap_interested_carpark(current_user.id, old_carpark_no, None):
+                # current_user.driver was out of date
+                db.session.rollback()
+                invalidate_identity(current_user.id)
+                return jsonify(success=False)
+            counts[carpark.car_park_no] = change_interested_drivers(carpark.car_park_no, -1)
             op_type = 0
         # user is indicating interest in a new carpark
         # op_type = 1 means user is indicating interest
-        elif carpark.car_park_no != driver.interested_carpark:
-            if driver.interested_carpark is not None:
-                old_carpark = CarPark.query.filter_by(car_park_no=driver.interested_carpark).first()
-                old_carpark.no_of_interested_drivers-=1
-            driver.interested_carpark = carpark.car_park_no
-            carpark.no_of_interested_drivers+=1
+        else:
+            if not swap_interested_carpark(current_user.id, old_carpark_no, carpark.car_park_no):
+                # current_user.driver was out of date
+                db.session.rollback()
+                invalidate_identity(current_user.id)
+                return jsonify(success=False)
+            if old_carpark_no is not None:
+                counts[old_carpark_no] = change_interested_drivers(old_carpark_no, -1)
+            counts[carpark.car_park_no] = change_interested_drivers(carpark.car_park_no, 1)
             op_type = 1
 
         db.session.commit()
-        generate_geojson()
-        with open('website/carparks.json') as f:
-            data = json.loads(f.read())
-        return jsonify(success=True, op_type = op_type, updatedgeojsondata=data)
+        invalidate_identity(current_user.id)
+
+        # Only the affected carparks are patched into the snapshot (within a couple of
+        # seconds, see patch_snapshot_feature) and sent back right away
+        updated_features = []
+        for car_park_no, count in counts.items():
+            if count is None:
+                continue
+            feature = patch_snapshot_feature(car_park_no, no_of_interested_drivers=count)
+            if feature is not None:
+                updated_features.append(feature)
+        return jsonify(success=True, op_type = op_type, updatedgeojsondata=updated_features)
     
     if intent == "delete_interested_carpark":
         # Do verification of parking image here
         # The prototype won't implement this.
-        carpark = CarPark.query.filter_by(car_park_no=driver.interested_carpark).first()
-        carpark.no_of_interested_drivers-=1
+        old_carpark_no = driver.interested_carpark
+        if old_carpark_no is None or not swap_interested_carpark(current_user.id, old_carpark_no, None):
+            db.session.rollback()
+            invalidate_identity(current_user.id)
+            return redirect(url_for("views.get_map"))
 
-        driver.interested_carpark = None
-        driver.points += 1
+        count = change_interested_drivers(old_carpark_no, -1)
+        add_driver_points(current_user.id, 1)
 
         # flash("Thanks for uploading, you've received 1 point!")
         db.session.commit()
-        generate_geojson()
+        invalidate_identity(current_user.id)
+        if count is not None:
+            patch_snapshot_feature(old_carpark_no, no_of_interested_drivers=count)
         return redirect(url_for("views.get_map"))
 
 @views.route('/parking_verification', methods=['GET'])
@@ -292,7 +423,7 @@ def put_drivers():
 def get_parking_verification():
     # Users should not be able to use this route if they don't have any
     # interested carparks
-    driver = Driver.query.filter_by(user_id = current_user.id).first()
+    driver = current_user.driver
     if driver.interested_carpark is None:
         #flash("You don't have any interested carpark!", "error")
         return redirect(url_for("views.get_map"))
@@ -300,10 +431,295 @@ def get_parking_verification():
     if request.method == "GET":
         return render_template("verify_parking.html", user=current_user)
 
+# Lot types in the availability feed: C for cars, Y for motorcycles and H for heavy vehicles
+LOT_TYPES = ('C', 'Y', 'H')
+
 # Returns geojson data
+# e.g. /carparks?lot_type=Y for the carparks with motorcycle lots, with their availability
 @views.route("/carparks", methods=["GET"])
 @role_required("driver")
 def get_carparks():
-    with open('website/carparks.json') as f:
-        data = json.loads(f.read())
-    return jsonify(data)
\ No newline at end of file
+    lot_type = request.args.get('lot_type')
+    if lot_type is None:
+        return snapshot_response(get_snapshot())
+    if lot_type not in LOT_TYPES:
+        return jsonify(error=f"lot_type must be one of {', '.join(LOT_TYPES)}"), 400
+    return snapshot_response(get_snapshot().for_lot_type(lot_type))
+
+# Sends the pre-serialized (and pre-compressed) snapshot body
+# Clients that already have this version get a 304 without a body
+def snapshot_response(snapshot):
+    encoding = None
+    for supported in snapshot.supported_encodings():
+        if request.accept_encodings[supported]:
+            encoding = supported
+            break
+
+    if encoding:
+        response = Response(snapshot.encoded(encoding), mimetype='application/json')
+        response.headers['Content-Encoding'] = encoding
+        # Each representation needs its own strong ETag
+        response.set_etag(f"{snapshot.etag}-{encoding}")
+    else:
+        response = Response(snapshot.body, mimetype='application/json')
+        response.set_etag(snapshot.etag)
+    response.last_modified = snapshot.last_modified
+    # Lets the client ask /carparks/changes for what changed after this version
+    response.headers['X-Carparks-Version'] = snapshot.token
+    response.vary.add('Accept-Encoding')
+    # Always revalidate, availability can change at any refresh
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    return response.make_conditional(request)
+
+# Furthest arrival time (in minutes) that expected lots are given for
+MAX_ARRIVE_IN = 180
+
+# Returns a function giving the expected lots available of a snapshot feature at `arrival`
+# Each call is a couple of lookups in the precomputed tables, see forecast.py
+def expected_lots_available_at(arrival):
+    forecaster = get_forecaster()
+    now = time()
+    def expected(feature):
+        return forecaster.expected_lots_available(
+            feature['car_park_no'], feature['lots_available'], arrival,
+            lot_type=feature.get('lot_type') or 'C', total_lots=feature['total_lots'], now=now)
+    return expected
+
+# Singapore is about 50km across, so a larger radius doesn't find any more carparks
+MAX_RADIUS_KM = 50
+MAX_LIMIT = 100
+
+# Parses the lat, lon and radius_km of a search around a point, and its optional limit
+# Raises ValueError with a message for the client if any of them is missing or out of range
+def parse_search_args(default_radius_km, default_limit=None):
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        radius_km = float(request.args.get('radius_km', default_radius_km))
+        limit = int(request.args['limit']) if 'limit' in request.args else default_limit
+    except (KeyError, ValueError):
+        raise ValueError("lat, lon, radius_km and limit must be numbers")
+    # comparisons with nan are always False, so it is rejected as well
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("lat and lon must be a valid position")
+    if not 0 < radius_km <= MAX_RADIUS_KM:
+        raise ValueError(f"radius_km must be more than 0 and at most {MAX_RADIUS_KM}")
+    if limit is not None and not 0 < limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    return lat, lon, radius_km, limit
+
+# Returns the carparks within radius_km of (lat, lon), answered from the spatial index
+# e.g. /carparks/nearby?lat=1.35&lon=103.82&radius_km=2&sort=vacancy&limit=20&lot_type=Y
+# With arrive_in (minutes), each carpark also gets the expected_lots_available when the
+# driver gets there, and sort=expected puts the carparks with the most of them first
+@views.route("/carparks/nearby", methods=["GET"])
+@role_required("driver")
+def get_nearby_carparks():
+    try:
+        lat, lon, radius_km, limit = parse_search_args(default_radius_km=1)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    try:
+        arrive_in = float(request.args['arrive_in']) if 'arrive_in' in request.args else None
+    except ValueError:
+        return jsonify(error="arrive_in must be a number"), 400
+
+    sort = request.args.get('sort', 'distance')
+    if sort not in ('distance', 'vacancy', 'expected'):
+        return jsonify(error="sort must be either distance, vacancy or expected"), 400
+    if arrive_in is not None and not 0 <= arrive_in <= MAX_ARRIVE_IN:
+        return jsonify(error=f"arrive_in must be between 0 and {MAX_ARRIVE_IN} minutes"), 400
+    lot_type = request.args.get('lot_type')
+    if lot_type is not None and lot_type not in LOT_TYPES:
+        return jsonify(error=f"lot_type must be one of {', '.join(LOT_TYPES)}"), 400
+
+    snapshot = get_snapshot()
+    if lot_type is not None:
+        snapshot = snapshot.for_lot_type(lot_type)
+
+    expected = None
+    key = None
+    if arrive_in is not None or sort == 'expected':
+        expected = expected_lots_available_at(time() + (arrive_in or 0) * 60)
+    if sort == 'expected':
+        key = lambda r: (-expected(r[1]), r[0])
+    results = snapshot.nearby(lat, lon, radius_km, sort=sort, limit=limit, key=key)
+
+    carparks = []
+    for distance, feature in results:
+        carpark = dict(feature, distance_in_km=round(distance, 1))
+        if expected is not None:
+            carpark['expected_lots_available'] = expected(feature)
+        carparks.append(carpark)
+    return jsonify(carparks)
+
+# Returns the best carparks within radius_km for the driver, best first, see recommend.py
+# e.g. /carparks/recommend?lat=1.35&lon=103.82&radius_km=3&limit=5&vehicle_height=2.1&arrive_in=15
+# vehicle_height (metres) leaves out carparks with a lower gantry, and with arrive_in the
+# lots expected at arrival are used instead of the current ones
+@views.route("/carparks/recommend", methods=["GET"])
+@role_required("driver")
+def get_recommended_carparks():
+    try:
+        lat, lon, radius_km, limit = parse_search_args(default_radius_km=2, default_limit=5)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    try:
+        vehicle_height = float(request.args['vehicle_height']) if 'vehicle_height' in request.args else None
+        arrive_in = float(request.args['arrive_in']) if 'arrive_in' in request.args else None
+    except ValueError:
+        return jsonify(error="vehicle_height and arrive_in must be numbers"), 400
+
+    if vehicle_height is not None and not 0 < vehicle_height < math.inf:
+        return jsonify(error="vehicle_height must be a positive number"), 400
+    if arrive_in is not None and not 0 <= arrive_in <= MAX_ARRIVE_IN:
+        return jsonify(error=f"arrive_in must be between 0 and {MAX_ARRIVE_IN} minutes"), 400
+    lot_type = request.args.get('lot_type')
+    if lot_type is not None and lot_type not in LOT_TYPES:
+        return jsonify(error=f"lot_type must be one of {', '.join(LOT_TYPES)}"), 400
+
+    snapshot = get_snapshot()
+    if lot_type is not None:
+        snapshot = snapshot.for_lot_type(lot_type)
+
+    arrival = time() + (arrive_in or 0) * 60
+    expected = expected_lots_available_at(arrival) if arrive_in is not None else None
+    results = recommend(snapshot, lat, lon, radius_km, arrival, limit=limit, vehicle_height=vehicle_height,
+                        expected=expected, own_carpark=current_user.driver.interested_carpark)
+
+    carparks = []
+    for score, distance, effective_lots, free, feature in results:
+        carparks.append(dict(feature, score=round(score, 3), distance_in_km=round(distance, 1),
+                             effective_lots_available=effective_lots, free_parking_now=free))
+    return jsonify(carparks)
+
+# Returns one carpark with the lots expected to be available in arrive_in minutes (default 15)
+# e.g. /carparks/A1?arrive_in=20&lot_type=Y
+@views.route("/carparks/<car_park_no>", methods=["GET"])
+@role_required("driver")
+def get_carpark(car_park_no):
+    arrive_in = request.args.get('arrive_in', 15, type=float)
+    if not 0 <= arrive_in <= MAX_ARRIVE_IN:
+        return jsonify(error=f"arrive_in must be between 0 and {MAX_ARRIVE_IN} minutes"), 400
+    lot_type = request.args.get('lot_type')
+    if lot_type is not None and lot_type not in LOT_TYPES:
+        return jsonify(error=f"lot_type must be one of {', '.join(LOT_TYPES)}"), 400
+
+    snapshot = get_snapshot()
+    if lot_type is not None:
+        snapshot = snapshot.for_lot_type(lot_type)
+    feature = snapshot.by_number.get(car_park_no)
+    if feature is None:
+        return jsonify(error="No such carpark"), 404
+    expected = expected_lots_available_at(time() + arrive_in * 60)
+    return jsonify(dict(feature, expected_lots_available=expected(feature), arrive_in=arrive_in))
+
+# Nothing older than the daily buckets is kept
+MAX_HISTORY_HOURS = RETENTION[DAILY] // 3600
+
+# Returns the availability of a carpark over the last `hours` hours, oldest first
+# e.g. /carparks/A1/history?lot_type=C&hours=24&resolution=hour
+# resolution (5min, hour or day) defaults to the finest one kept for the whole range
+@views.route("/carparks/<car_park_no>/history", methods=["GET"])
+@role_required("driver")
+def get_carpark_history(car_park_no):
+    hours = request.args.get('hours', 24, type=float)
+    # comparisons with nan are always False, so it is rejected as well
+    if not 0 < hours <= MAX_HISTORY_HOURS:
+        return jsonify(error=f"hours must be more than 0 and at most {MAX_HISTORY_HOURS}"), 400
+    lot_type = request.args.get('lot_type', 'C')
+    if lot_type not in LOT_TYPES:
+        return jsonify(error=f"lot_type must be one of {', '.join(LOT_TYPES)}"), 400
+    resolution = request.args.get('resolution')
+    if resolution is not None and resolution not in RESOLUTIONS:
+        return jsonify(error=f"resolution must be one of {', '.join(RESOLUTIONS)}"), 400
+
+    now = int(time())
+    history = get_availability_history(car_park_no, lot_type, start=now - int(hours * 3600), end=now,
+                                       resolution=RESOLUTIONS.get(resolution), now=now)
+    feature = get_snapshot().by_number.get(car_park_no)
+    lots = feature.get('lots', {}).get(lot_type) if feature else None
+    return jsonify(car_park_no=car_park_no, lot_type=lot_type,
+                   total_lots=lots[0] if lots else None, history=history)
+
+# Returns only the carparks that changed since the given snapshot version
+# If the version is too old, full_refetch tells the client to get /carparks again
+@views.route("/carparks/changes", methods=["GET"])
+@role_required("driver")
+def get_carpark_changes():
+    since = request.args.get('since')
+    if not since:
+        return jsonify(error="since must be a snapshot version"), 400
+
+    changes = get_changes_since(since)
+    if changes is None:
+        return jsonify(version=get_snapshot().token, full_refetch=True)
+    return jsonify(full_refetch=False, **changes)
+
+# Returns what the map should draw inside bbox at the zoom level: the carparks that are on
+# their own and one summary per cluster, with its point_count, summed lots and interested
+# drivers, and the expansion_zoom at which it splits up
+# e.g. /carparks/clusters?bbox=103.6,1.2,104.1,1.5&zoom=11&lot_type=C
+@views.route("/carparks/clusters", methods=["GET"])
+@role_required("driver")
+def get_carpark_clusters():
+    try:
+        bbox = tuple(float(value) for value in request.args['bbox'].split(','))
+    except (KeyError, ValueError):
+        bbox = ()
+    if len(bbox) != 4 or not all(math.isfinite(value) for value in bbox):
+        return jsonify(error="bbox must be min_lon,min_lat,max_lon,max_lat"), 400
+    zoom = request.args.get('zoom', type=float)
+    if zoom is None or not math.isfinite(zoom):
+        return jsonify(error="zoom must be a number"), 400
+    lot_type = request.args.get('lot_type')
+    if lot_type is not None and lot_type not in LOT_TYPES:
+        return jsonify(error=f"lot_type must be one of {', '.join(LOT_TYPES)}"), 400
+
+    snapshot = get_snapshot()
+    if lot_type is not None:
+        snapshot = snapshot.for_lot_type(lot_type)
+    return jsonify(version=snapshot.token, zoom=level_for(zoom), features=snapshot.clusters_in(bbox, zoom))
+
+# Server-sent events with availability and interest changes for the carparks in bbox
+# e.g. /carparks/stream?bbox=103.8,1.3,103.9,1.4 (min lon, min lat, max lon, max lat)
+@views.route("/carparks/stream", methods=["GET"])
+@role_required("driver")
+def get_carpark_stream():
+    bbox = None
+    if request.args.get('bbox'):
+        try:
+            bbox = tuple(float(value) for value in request.args['bbox'].split(','))
+        except ValueError:
+            bbox = ()
+        if len(bbox) != 4:
+            return jsonify(error="bbox must be min_lon,min_lat,max_lon,max_lat"), 400
+
+    # A reconnecting EventSource sends the last version it saw, so catch it up first
+    catch_up = None
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id:
+        changes = get_changes_since(last_event_id)
+        if changes is None:
+            catch_up = {'version': get_snapshot().token, 'full_refetch': True}
+        elif changes['added'] or changes['removed']:
+            catch_up = {'version': changes['version'], 'full_refetch': True}
+        elif changes['changed']:
+            catch_up = {'version': changes['version'], 'since': last_event_id, 'full_refetch': False,
+                        'changed': changes['changed']}
+
+    # Each stream holds a thread until the client goes away, see MAX_EVENT_STREAMS
+    if not broker.subscribe(current_app.config['MAX_EVENT_STREAMS']):
+        response = jsonify(error="Too many open streams, try again later")
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+
+    response = Response(broker.stream(bbox, catch_up), mimetype='text/event-stream')
+    # Runs when the server closes the response, even if the client left before the first event
+    response.call_on_close(broker.unsubscribe)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop reverse proxies (e.g. nginx) from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
\ No newline at end of file